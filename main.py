@@ -11,6 +11,11 @@ from src.camera_interface import CameraInterface
 from src.main_interface import MainInterface
 
 from src.face_detect_interface import FaceDetector
+from src.process_detector import ProcessDetector
+from src.roi_detector import RoiDetector
+from src.flow_tracker import FlowTracker
+from src.sort_tracker import SortTracker
+from src.motion_gate import MotionGate
 from src.servo_manager import ServoManager
 from src.camera_manager import CameraManager
 
@@ -25,14 +30,63 @@ class Window(MSFluentWindow):
         self.settings = QSettings("config/setting.ini", QSettings.IniFormat)
 
         # 初始化人脸识别检测器
-        self.face_detector = FaceDetector("weights/FaceBoxes.pth")
+        detector_kwargs = dict(nms_backend=self.settings.value("NmsBackend", "auto"),
+                               infer_size=self.settings.value("InferSize", "full"),
+                               fused=str(self.settings.value("FusedModel", "false")).lower() == "true",
+                               engine=self.settings.value("Engine", "eager"),
+                               quantized=str(self.settings.value("Quantized", "false")).lower() == "true",
+                               precision=self.settings.value("Precision", "fp32"),
+                               autotune=str(self.settings.value("AutoTune", "true")).lower() == "true")
+        workers = int(self.settings.value("InferenceWorkers", 0))
+        if workers > 0:
+            # 在子进程中推理,图像经共享内存传递
+            # 帧环槽位按配置的采集分辨率分配,相机实际协商出更大的分辨率时自动重建
+            frame_shape = (max(int(self.settings.value("CamHeight", 720)), 720),
+                           max(int(self.settings.value("CamWidth", 1280)), 1280), 3)
+            self.face_detector = ProcessDetector("weights/FaceBoxes.pth", workers=workers, frame_shape=frame_shape,
+                                                 **detector_kwargs)
+        else:
+            self.face_detector = FaceDetector("weights/FaceBoxes.pth", **detector_kwargs)
+        # 追踪时使用的检测器: 找到人脸后只在目标周围的局部区域内检测
+        roi_tracking = str(self.settings.value("RoiTracking", "true")).lower() == "true"
+        self.track_detector = RoiDetector(self.face_detector,
+                                          enabled=roi_tracking,
+                                          pad=float(self.settings.value("RoiPad", 0.5)),
+                                          full_interval=int(self.settings.value("RoiFullInterval", 30)))
+        # 在后台调优相机分辨率对应的推理尺寸和局部区域的各档尺寸,推理线程不做调优
+        cam_width, cam_height = int(self.settings.value("CamWidth", 1280)), int(self.settings.value("CamHeight", 720))
+        tune_shapes = [self.face_detector.getInferShape(cam_width, cam_height)]
+        if roi_tracking:
+            tune_shapes += [(size, size) for size in self.track_detector.getRoiInferSizes(cam_width, cam_height)]
+        self.face_detector.setTuneShapes(tune_shapes)
+        # 多人脸跟踪,按轨迹选择追踪目标
+        if str(self.settings.value("MultiFaceTracking", "true")).lower() == "true":
+            self.track_detector = SortTracker(self.track_detector,
+                                              policy=self.settings.value("TargetPolicy", "sticky"))
+        # 两次检测之间用光流跟踪目标,检测间隔随目标运动自适应
+        self.track_detector = FlowTracker(self.track_detector,
+                                          enabled=str(self.settings.value("FlowTracking", "true")).lower() == "true",
+                                          min_interval=int(self.settings.value("DetectMinInterval", 2)),
+                                          max_interval=int(self.settings.value("DetectMaxInterval", 10)))
+        # 画面静止时跳过检测,复用上一次的结果
+        self.track_detector = MotionGate(self.track_detector,
+                                         enabled=str(self.settings.value("MotionGate", "true")).lower() == "true",
+                                         pixel_thresh=int(self.settings.value("MotionPixelThresh", 12)),
+                                         area_thresh=float(self.settings.value("MotionAreaThresh", 0.002)),
+                                         refresh_interval=int(self.settings.value("MotionRefreshInterval", 30)))
         # 初始化舵机驱动
         self.servo_manager = ServoManager()
         # 初始化相机驱动
-        self.camera_manager = CameraManager()
+        self.camera_manager = CameraManager(grab_mode=self.settings.value("CaptureMode", "grab") == "grab",
+                                            width=int(self.settings.value("CamWidth", 1280)),
+                                            height=int(self.settings.value("CamHeight", 720)),
+                                            fps=float(self.settings.value("CamFPS", 30)),
+                                            fourcc=self.settings.value("CamFourcc", "MJPG"),
+                                            backend=self.settings.value("CamBackend", "auto"),
+                                            buffer_size=int(self.settings.value("CamBufferSize", 1)))
 
         # 添加子界面
-        self.mainInterface = MainInterface(self.face_detector, self.camera_manager, self.servo_manager, self)
+        self.mainInterface = MainInterface(self.track_detector, self.camera_manager, self.servo_manager, self)
         self.cameraInterface = CameraInterface(self.face_detector, self.camera_manager, self)
         self.servoInterface = ServoInterface(self.servo_manager, self)
 
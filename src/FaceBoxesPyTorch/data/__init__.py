@@ -1,3 +1,17 @@
-from .wider_voc import VOCDetection, AnnotationTransform, detection_collate
-from .data_augment import *
 from .config import *
+
+# The dataset and augmentation modules need torch. They are imported on first use so
+# that inference paths which only read cfg (cv2.dnn) do not load torch.
+_LAZY = {
+    'VOCDetection': 'wider_voc',
+    'AnnotationTransform': 'wider_voc',
+    'detection_collate': 'wider_voc',
+    'preproc': 'data_augment',
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    import importlib
+    return getattr(importlib.import_module('.' + _LAZY[name], __name__), name)
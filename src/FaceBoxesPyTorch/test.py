@@ -5,7 +5,7 @@ import torch
 import torch.backends.cudnn as cudnn
 import numpy as np
 from data import cfg
-from layers.functions.prior_box import PriorBox
+from layers.functions.prior_box import get_priors
 from utils.nms_wrapper import nms
 # from utils.nms.py_cpu_nms import py_cpu_nms
 import cv2
@@ -119,8 +119,7 @@ if __name__ == '__main__':
         loc, conf = net(img)  # forward pass
         _t['forward_pass'].toc()
         _t['misc'].tic()
-        priorbox = PriorBox(cfg, image_size=(im_height, im_width))
-        priors = priorbox.forward()
+        priors = get_priors(cfg, (im_height, im_width))
         priors = priors.to(device)
         prior_data = priors.data
         boxes = decode(loc.data.squeeze(0), prior_data, cfg['variance'])
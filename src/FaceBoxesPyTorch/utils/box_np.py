@@ -0,0 +1,93 @@
+"""numpy-only prior generation and box decoding, used by inference paths that do not load torch (cv2.dnn)."""
+import numpy as np
+from math import ceil
+from collections import OrderedDict
+from threading import Lock
+
+
+def _dense_offsets(min_size):
+    # anchor densification of the FaceBoxes paper: 4x4 for 32, 2x2 for 64, centered otherwise
+    if min_size == 32:
+        return np.array([0, 0.25, 0.5, 0.75])
+    elif min_size == 64:
+        return np.array([0, 0.5])
+    return np.array([0.5])
+
+
+def prior_boxes(cfg, image_size):
+    """Generate all anchors for an input of ``image_size`` (height, width) with broadcasting.
+
+    The anchor order matches the original per-cell loop exactly: row-major over
+    feature map cells, then min_sizes, then dense (cy, cx) offsets.
+    Returns a float32 array of shape [num_priors, 4] in center-offset form.
+    """
+    im_h, im_w = image_size
+    anchors = []
+    for k, step in enumerate(cfg['steps']):
+        f = [ceil(im_h / step), ceil(im_w / step)]
+        rows = np.arange(f[0], dtype=np.float64)
+        cols = np.arange(f[1], dtype=np.float64)
+        cell_anchors = []
+        for min_size in cfg['min_sizes'][k]:
+            offsets = _dense_offsets(min_size)
+            n = offsets.size
+            # [f0, 1, n, 1] x [1, f1, 1, n] -> [f0, f1, n * n]
+            cy = (rows[:, None, None, None] + offsets[None, None, :, None]) * step / im_h
+            cx = (cols[None, :, None, None] + offsets[None, None, None, :]) * step / im_w
+            cy, cx = np.broadcast_arrays(cy, cx)
+            a = np.empty((f[0], f[1], n * n, 4), dtype=np.float64)
+            a[..., 0] = cx.reshape(f[0], f[1], n * n)
+            a[..., 1] = cy.reshape(f[0], f[1], n * n)
+            a[..., 2] = min_size / im_w
+            a[..., 3] = min_size / im_h
+            cell_anchors.append(a)
+        anchors.append(np.concatenate(cell_anchors, axis=2).reshape(-1, 4))
+    output = np.concatenate(anchors, axis=0).astype(np.float32)
+    if cfg['clip']:
+        np.clip(output, 0, 1, out=output)
+    return output
+
+
+_PRIORS_CACHE = OrderedDict()
+_PRIORS_CACHE_SIZE = 8
+_PRIORS_LOCK = Lock()
+
+
+def get_priors_np(cfg, image_size):
+    """Return the prior boxes for an input of ``image_size`` (height, width) as a numpy array.
+
+    Priors only depend on the input shape, so they are generated once per shape and
+    kept in a small LRU cache shared by inference, evaluation and training.
+    The returned array is shared between callers and must not be modified in place.
+    """
+    key = (int(image_size[0]), int(image_size[1]),
+           tuple(tuple(s) for s in cfg['min_sizes']), tuple(cfg['steps']), cfg['clip'])
+    with _PRIORS_LOCK:
+        priors = _PRIORS_CACHE.get(key)
+        if priors is not None:
+            _PRIORS_CACHE.move_to_end(key)
+            return priors
+    priors = prior_boxes(cfg, key[:2])
+    with _PRIORS_LOCK:
+        _PRIORS_CACHE[key] = priors
+        while len(_PRIORS_CACHE) > _PRIORS_CACHE_SIZE:
+            _PRIORS_CACHE.popitem(last=False)
+    return priors
+
+
+def decode_np(loc, priors, variances):
+    """
+    numpy version of decode, used to decode only the priors kept after score culling
+    Args:
+        loc (ndarray): location predictions, Shape: [num,4]
+        priors (ndarray): Prior boxes in center-offset form, Shape: [num,4].
+        variances: (list[float]) Variances of priorboxes
+    Return:
+        decoded bounding box predictions, Shape: [num,4]
+    """
+    boxes = np.empty(loc.shape, dtype=np.float32)
+    boxes[:, :2] = priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:]
+    boxes[:, 2:] = priors[:, 2:] * np.exp(loc[:, 2:] * variances[1])
+    boxes[:, :2] -= boxes[:, 2:] / 2
+    boxes[:, 2:] += boxes[:, :2]
+    return boxes
@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+from src.FaceBoxesPyTorch.utils.box_np import decode_np
 
 
 def point_form(boxes):
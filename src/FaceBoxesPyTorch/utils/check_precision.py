@@ -0,0 +1,40 @@
+"""Measure the detection loss of the bfloat16/float16 modes against float32.
+
+Runs FaceDetector in float32 and in each reduced precision the CPU supports
+natively on recorded frames, and prints the same report as the INT8 tool.
+
+    python -m src.FaceBoxesPyTorch.utils.check_precision --calib_dir data/calib
+"""
+from __future__ import print_function
+import argparse
+import torch
+from src.FaceBoxesPyTorch.utils.quantize import load_frames, accuracy_report
+
+
+if __name__ == '__main__':
+    from src.face_detect_interface import FaceDetector
+    from src.detect_engine import native_precisions
+
+    parser = argparse.ArgumentParser(description='FaceBoxes reduced precision check')
+    parser.add_argument('-m', '--trained_model', default='weights/FaceBoxes.pth', type=str)
+    parser.add_argument('--calib_dir', default='data/calib', type=str, help='recorded frames folder')
+    parser.add_argument('--num_frames', default=200, type=int)
+    parser.add_argument('--infer_size', default='full', type=str, help='same as InferSize in setting.ini')
+    parser.add_argument('--engine', default='eager', type=str, help='same as Engine in setting.ini')
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    frames = load_frames(args.calib_dir, args.num_frames)
+    assert len(frames) > 0, 'no recorded frames'
+
+    print('Native precisions on this CPU: {}'.format(', '.join(native_precisions())))
+    float_detector = FaceDetector(args.trained_model, infer_size=args.infer_size, engine=args.engine)
+    for precision in native_precisions()[1:]:
+        detector = FaceDetector(args.trained_model, infer_size=args.infer_size, engine=args.engine,
+                                precision=precision)
+        # warm up both detectors so one-off engine builds are not timed
+        accuracy_report(float_detector, detector, frames[:1], name=precision)
+        report = accuracy_report(float_detector, detector, frames, name=precision)
+        print('{} accuracy report ({} frames):'.format(precision, report.pop('frames')))
+        for k, v in report.items():
+            print('  {:<16s} {}'.format(k, v if isinstance(v, int) else '{:.4f}'.format(v)))
@@ -0,0 +1,83 @@
+"""Export FaceBoxes to ONNX for runtimes without torch (e.g. cv2.dnn)."""
+from __future__ import print_function
+import os
+import time
+import argparse
+import numpy as np
+import torch
+
+
+def export_onnx(net, path, image_size=(720, 1280), opset=11):
+    """Export a FaceBoxes(phase='test') network, softmax included.
+
+    cv2.dnn works best with static shapes, so the graph is exported for one
+    input size; export one file per inference size.
+    Args:
+        net: FaceBoxes in eval mode, phase='test'
+        path: output .onnx file
+        image_size: (height, width) of the network input
+    Return:
+        path
+    """
+    assert net.phase == 'test', 'export FaceBoxes(phase=\'test\') to keep the softmax in the graph'
+    dummy = torch.zeros(1, 3, image_size[0], image_size[1])
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    kwargs = dict(input_names=['input'], output_names=['loc', 'conf'], opset_version=opset,
+                  do_constant_folding=True)
+    with torch.no_grad():
+        try:
+            # torch >= 2.5 defaults to the dynamo exporter, keep the TorchScript one for static graphs
+            torch.onnx.export(net, dummy, path, dynamo=False, **kwargs)
+        except TypeError:
+            torch.onnx.export(net, dummy, path, **kwargs)
+    return path
+
+
+def check_onnx(net, path, image_size=(720, 1280), repeat=10):
+    """Compare cv2.dnn against torch on a random image and time both runtimes.
+
+    Return:
+        (max loc error, max conf error, torch ms, cv2.dnn ms)
+    """
+    import cv2
+
+    img = torch.randint(0, 256, (1, 3) + tuple(image_size), generator=torch.Generator().manual_seed(0)).float()
+    img -= torch.tensor([104, 117, 123], dtype=torch.float32).reshape(1, 3, 1, 1)
+    dnn = cv2.dnn.readNetFromONNX(path)
+
+    def run_dnn():
+        dnn.setInput(img.numpy())
+        return dnn.forward(['loc', 'conf'])
+
+    with torch.no_grad():
+        loc_t, conf_t = net(img)
+        loc_d, conf_d = run_dnn()
+        t = time.perf_counter()
+        for _ in range(repeat):
+            net(img)
+        torch_ms = (time.perf_counter() - t) / repeat * 1000
+    t = time.perf_counter()
+    for _ in range(repeat):
+        run_dnn()
+    dnn_ms = (time.perf_counter() - t) / repeat * 1000
+    return (np.abs(loc_t.numpy() - loc_d).max(), np.abs(conf_t.numpy() - conf_d).max(), torch_ms, dnn_ms)
+
+
+if __name__ == '__main__':
+    from src.face_detect_interface import FaceDetector
+
+    parser = argparse.ArgumentParser(description='Export FaceBoxes to ONNX')
+    parser.add_argument('-m', '--trained_model', default='weights/FaceBoxes.pth', type=str)
+    parser.add_argument('-o', '--output', default='weights/FaceBoxes.onnx', type=str)
+    parser.add_argument('--width', default=1280, type=int)
+    parser.add_argument('--height', default=720, type=int)
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    net = FaceDetector(args.trained_model).getNet()
+    export_onnx(net, args.output, (args.height, args.width))
+    loc_err, conf_err, torch_ms, dnn_ms = check_onnx(net, args.output, (args.height, args.width))
+    print('Exported {}: max loc error {:.2e}, max conf error {:.2e}'.format(args.output, loc_err, conf_err))
+    print('forward pass torch: {:.1f}ms, cv2.dnn: {:.1f}ms'.format(torch_ms, dnn_ms))
@@ -0,0 +1,142 @@
+"""Deploy-time conversion of FaceBoxes for inference.
+
+Every BatchNorm2d is folded into the preceding convolution, and the input mean
+subtraction is folded into conv1 so the fused network consumes raw BGR pixels.
+"""
+from __future__ import print_function
+import os
+import copy
+import argparse
+import torch
+import torch.nn as nn
+from src.FaceBoxesPyTorch.models.faceboxes import FaceBoxes, BasicConv2d, CRelu
+from src.FaceBoxesPyTorch.utils.weight_paths import fused_weight_path
+
+
+def fuse_conv_bn(conv, bn):
+    """Return a Conv2d with bias computing bn(conv(x)) in eval mode."""
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True)
+    s = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.weight.data.copy_(conv.weight * s.reshape(-1, 1, 1, 1))
+    fused.bias.data.copy_((bias - bn.running_mean) * s + bn.bias)
+    return fused
+
+
+class MeanFoldedConv2d(nn.Module):
+    """Conv2d on ``x - mean`` computed from raw ``x``.
+
+    With zero padding, conv(x - m) = conv(x) - conv(m), where conv(m) is the
+    response to a constant image. Inside the image it is constant. At the
+    borders it differs because of the padding. It only depends on the input
+    shape, so the exact bias map is computed once per shape and cached.
+    """
+
+    def __init__(self, conv, mean):
+        super(MeanFoldedConv2d, self).__init__()
+        self.conv = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                              padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=False)
+        self.conv.weight.data.copy_(conv.weight.data)
+        self.register_buffer('bias', conv.bias.data.clone() if conv.bias is not None
+                             else torch.zeros(conv.out_channels))
+        self.register_buffer('mean', torch.as_tensor(mean, dtype=torch.float32).clone())
+        self._bias_maps = {}
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._bias_maps = {}
+        super(MeanFoldedConv2d, self)._load_from_state_dict(*args, **kwargs)
+
+    def bias_map(self, x):
+        key = (tuple(x.shape[-2:]), x.dtype)
+        bias_map = self._bias_maps.get(key)
+        if bias_map is None:
+            const = self.mean.to(x.dtype).reshape(1, -1, 1, 1).expand(1, -1, x.shape[-2], x.shape[-1])
+            bias_map = self.bias.to(x.dtype).reshape(1, -1, 1, 1) - self.conv(const)
+            self._bias_maps[key] = bias_map
+        return bias_map
+
+    def forward(self, x):
+        return self.conv(x) + self.bias_map(x)
+
+
+def fuse_faceboxes(net, mean=(104, 117, 123)):
+    """Fold BN (and optionally the input mean) into the convolutions of ``net`` in place.
+
+    Args:
+        net: FaceBoxes in eval mode
+        mean: BGR mean to fold into conv1, None keeps the mean subtraction outside the net
+    Return:
+        net, with ``net.input_mean`` set to the mean the caller still has to subtract
+    """
+    for m in net.modules():
+        if isinstance(m, (BasicConv2d, CRelu)) and isinstance(m.bn, nn.BatchNorm2d):
+            m.conv = fuse_conv_bn(m.conv, m.bn)
+            m.bn = nn.Identity()
+    if mean is not None:
+        net.conv1.conv = MeanFoldedConv2d(net.conv1.conv, mean)
+        net.input_mean = (0, 0, 0)
+    else:
+        net.input_mean = (104, 117, 123)
+    return net
+
+
+def build_fused_faceboxes(num_classes=2, fold_mean=True):
+    """Fused FaceBoxes skeleton, used to load weights saved by save_fused."""
+    net = FaceBoxes(phase='test', size=None, num_classes=num_classes)
+    net.eval()
+    return fuse_faceboxes(net, (104, 117, 123) if fold_mean else None)
+
+
+def save_fused(net, path):
+    torch.save({'state_dict': net.state_dict(),
+                'fold_mean': isinstance(net.conv1.conv, MeanFoldedConv2d),
+                'num_classes': net.num_classes}, path)
+
+
+def load_fused(path):
+    ckpt = torch.load(path, map_location=lambda storage, loc: storage)
+    net = build_fused_faceboxes(ckpt['num_classes'], ckpt['fold_mean'])
+    net.load_state_dict(ckpt['state_dict'], strict=True)
+    net.eval()
+    return net
+
+
+def check_fused(ref_net, fused_net, image_size=(720, 1280), num_images=2, atol=1e-3):
+    """Compare the fused network against the original one on random images.
+
+    Return:
+        (ok, max loc error, max conf error)
+    """
+    mean = torch.tensor([104, 117, 123], dtype=torch.float32).reshape(1, 3, 1, 1)
+    fused_mean = torch.tensor(fused_net.input_mean, dtype=torch.float32).reshape(1, 3, 1, 1)
+    gen = torch.Generator().manual_seed(0)
+    loc_err = conf_err = 0.
+    with torch.no_grad():
+        for _ in range(num_images):
+            img = torch.randint(0, 256, (1, 3) + tuple(image_size), generator=gen).float()
+            loc_r, conf_r = ref_net(img - mean)
+            loc_f, conf_f = fused_net(img - fused_mean)
+            loc_err = max(loc_err, (loc_r - loc_f).abs().max().item())
+            conf_err = max(conf_err, (conf_r - conf_f).abs().max().item())
+    return loc_err <= atol and conf_err <= atol, loc_err, conf_err
+
+
+def convert_faceboxes(ref_net, fold_mean=True, atol=1e-3):
+    """Fuse a copy of ``ref_net`` and verify it against the original network."""
+    fused = fuse_faceboxes(copy.deepcopy(ref_net).eval(), (104, 117, 123) if fold_mean else None)
+    ok, loc_err, conf_err = check_fused(ref_net, fused, atol=atol)
+    print('Fused model max loc error: {:.2e}, max conf error: {:.2e}'.format(loc_err, conf_err))
+    assert ok, 'fused network is not equivalent to the original one'
+    return fused
+
+
+if __name__ == '__main__':
+    from src.face_detect_interface import FaceDetector
+
+    parser = argparse.ArgumentParser(description='Fuse FaceBoxes for deployment')
+    parser.add_argument('-m', '--trained_model', default='weights/FaceBoxes.pth', type=str)
+    args = parser.parse_args()
+
+    # converts, checks and saves weights/xxx_fused.pth when it does not exist yet
+    FaceDetector(args.trained_model, fused=True)
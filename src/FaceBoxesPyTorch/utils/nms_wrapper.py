@@ -5,27 +5,157 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
-from src.FaceBoxesPyTorch.utils.nms.cpu_nms import cpu_nms, cpu_soft_nms
-# from utils.nms.gpu_nms import gpu_nms
+import sys
+import time
+import importlib.util
+from collections import OrderedDict
+import numpy as np
+from src.FaceBoxesPyTorch.utils.nms.py_cpu_nms import py_cpu_nms
 
+# All backends follow the same convention as cpu_nms/py_cpu_nms: boxes are
+# inclusive pixel coordinates (area = (x2 - x1 + 1) * (y2 - y1 + 1)) and the
+# returned indices are ordered by descending score.
+_BACKENDS = OrderedDict()
+# backends that need torch, only benchmarked when torch is already loaded so that
+# picking an NMS implementation never pulls torch into a process that runs without it
+_TORCH_BACKENDS = set()
+_active = None
+_auto_choice = None
 
-# def nms(dets, thresh, force_cpu=False):
-#     """Dispatch to either CPU or GPU NMS implementations."""
-#
-#     if dets.shape[0] == 0:
-#         return []
-#     if cfg.USE_GPU_NMS and not force_cpu:
-#         return gpu_nms(dets, thresh, device_id=cfg.GPU_ID)
-#     else:
-#         return cpu_nms(dets, thresh)
+
+def register_backend(name, fn, needs_torch=False):
+    """Register an NMS implementation ``fn(dets, thresh) -> keep``."""
+    _BACKENDS[name] = fn
+    if needs_torch:
+        _TORCH_BACKENDS.add(name)
+
+
+def numpy_nms(dets, thresh):
+    """NMS on a precomputed IoU matrix, only the greedy pass stays in Python."""
+    scores = dets[:, 4]
+    order = scores.argsort()[::-1]
+    boxes = dets[order, :4]
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    w = np.maximum(0.0, np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]) + 1)
+    h = np.maximum(0.0, np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]) + 1)
+    inter = w * h
+    over = inter > thresh * (areas[:, None] + areas[None, :] - inter)
+
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= over[i]
+    return order[keep]
+
+
+# the IoU matrix grows quadratically, fall back to the iterative version for large inputs
+_NUMPY_NMS_MAX_BOXES = 1024
+
+
+def _numpy_backend(dets, thresh):
+    if dets.shape[0] > _NUMPY_NMS_MAX_BOXES:
+        return py_cpu_nms(dets, thresh)
+    return numpy_nms(dets, thresh)
+
+
+register_backend('numpy', _numpy_backend)
+register_backend('python', py_cpu_nms)
+
+if importlib.util.find_spec('torchvision') is not None:
+    def _torchvision_backend(dets, thresh):
+        # imported on first use, see _TORCH_BACKENDS
+        import torch
+        from torchvision.ops import nms as _tv_nms
+        # torchvision uses exclusive coordinates, shift x2/y2 (on a copy) to keep the +1 convention
+        boxes = torch.from_numpy(dets[:, :4].astype(np.float32, copy=True))
+        boxes[:, 2:] += 1
+        scores = torch.from_numpy(np.ascontiguousarray(dets[:, 4], dtype=np.float32))
+        return _tv_nms(boxes, scores, thresh).numpy()
+
+    register_backend('torchvision', _torchvision_backend, needs_torch=True)
+
+try:
+    from src.FaceBoxesPyTorch.utils.nms.cpu_nms import cpu_nms
+
+    def _cython_backend(dets, thresh):
+        return cpu_nms(np.ascontiguousarray(dets, dtype=np.float32), thresh)
+
+    register_backend('cython', _cython_backend)
+except ImportError:
+    pass
+
+
+def _benchmark_dets(num_boxes=128, seed=0):
+    """Synthetic detections clustered around a few faces, similar to real pre-NMS output."""
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(100, 600, size=(8, 2))
+    c = centers[rng.randint(0, len(centers), num_boxes)] + rng.normal(0, 8, size=(num_boxes, 2))
+    s = rng.uniform(40, 120, size=(num_boxes, 1))
+    dets = np.hstack((c - s / 2, c + s / 2, rng.uniform(0.05, 1, size=(num_boxes, 1))))
+    return dets.astype(np.float32)
+
+
+def select_backend(repeat=5):
+    """Pick the fastest backend that agrees with py_cpu_nms on a synthetic workload."""
+    global _active, _auto_choice
+    dets = _benchmark_dets()
+    expected = list(py_cpu_nms(dets, 0.3))
+    best, best_time = 'python', None
+    for name, fn in _BACKENDS.items():
+        if name in _TORCH_BACKENDS and 'torch' not in sys.modules:
+            continue
+        try:
+            if list(fn(dets, 0.3)) != expected:
+                continue
+            cost = None
+            for _ in range(repeat):
+                t = time.perf_counter()
+                fn(dets, 0.3)
+                t = time.perf_counter() - t
+                cost = t if cost is None else min(cost, t)
+        except Exception:
+            continue
+        if best_time is None or cost < best_time:
+            best, best_time = name, cost
+    _active = _auto_choice = best
+    return _active
+
+
+def set_backend(name):
+    """Force a backend by name, ``'auto'`` (or empty) keeps the self benchmark choice."""
+    global _active
+    if not name or name == 'auto':
+        if _auto_choice is None:
+            return select_backend()
+        _active = _auto_choice
+        return _active
+    if name not in _BACKENDS:
+        raise ValueError('unknown nms backend {}, available: {}'.format(name, list(_BACKENDS)))
+    _active = name
+    return _active
+
+
+def get_backend():
+    return _active
+
+
+def available_backends():
+    return list(_BACKENDS)
 
 
 def nms(dets, thresh, force_cpu=False):
-    """Dispatch to either CPU or GPU NMS implementations."""
+    """Dispatch to the active NMS backend.
+
+    ``force_cpu`` is kept for compatibility, every registered backend runs on the CPU.
+    """
 
     if dets.shape[0] == 0:
         return []
-    if force_cpu:
-        #return cpu_soft_nms(dets, thresh, method = 0)
-        return cpu_nms(dets, thresh)
-    # return gpu_nms(dets, thresh)
+    if _active is None:
+        select_backend()
+    return _BACKENDS[_active](dets, thresh)
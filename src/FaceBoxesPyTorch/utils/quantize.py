@@ -0,0 +1,292 @@
+"""Static post-training INT8 quantization of FaceBoxes.
+
+Workflow:
+    1. capture calibration frames from our own cameras (or use a folder of images)
+    2. build QuantFaceBoxes from the float model (conv+bn+relu fused)
+    3. calibrate the observers on the frames and convert to INT8 (fbgemm / qnnpack)
+    4. report the detection accuracy against the float model on the same frames
+    5. save weights/FaceBoxes_int8.pth, loaded by FaceDetector(quantized=True)
+
+    python -m src.FaceBoxesPyTorch.utils.quantize --camera 0 --num_frames 200
+    python -m src.FaceBoxesPyTorch.utils.quantize --calib_dir data/calib
+"""
+from __future__ import print_function
+import os
+import copy
+import glob
+import time
+import warnings
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.quantization as tq
+import torch.ao.nn.intrinsic as nni
+import torch.ao.nn.quantized as nnq
+from src.FaceBoxesPyTorch.models.faceboxes import FaceBoxes
+from src.FaceBoxesPyTorch.utils.fuse_model import fuse_conv_bn
+from src.FaceBoxesPyTorch.utils.weight_paths import quantized_weight_path
+
+
+def _fuse_basic(m):
+    """BasicConv2d -> ConvReLU2d with the BN folded in."""
+    seq = nn.Sequential(copy.deepcopy(m.conv), copy.deepcopy(m.bn), nn.ReLU()).eval()
+    return tq.fuse_modules(seq, [['0', '1', '2']])[0]
+
+
+def _fuse_crelu(m):
+    """CRelu -> one ConvReLU2d, relu(cat([x, -x])) == relu(conv with weights [W; -W])."""
+    conv = fuse_conv_bn(m.conv, m.bn)
+    double = nn.Conv2d(conv.in_channels, conv.out_channels * 2, conv.kernel_size, stride=conv.stride,
+                       padding=conv.padding, bias=True)
+    double.weight.data.copy_(torch.cat([conv.weight.data, -conv.weight.data], 0))
+    double.bias.data.copy_(torch.cat([conv.bias.data, -conv.bias.data], 0))
+    return nni.ConvReLU2d(double, nn.ReLU())
+
+
+class QuantInception(nn.Module):
+
+    def __init__(self, inception):
+        super(QuantInception, self).__init__()
+        for name in ('branch1x1', 'branch1x1_2', 'branch3x3_reduce', 'branch3x3',
+                     'branch3x3_reduce_2', 'branch3x3_2', 'branch3x3_3'):
+            setattr(self, name, _fuse_basic(getattr(inception, name)))
+        self.cat = nnq.FloatFunctional()
+
+    def forward(self, x):
+        branch1x1 = self.branch1x1(x)
+
+        branch1x1_pool = F.avg_pool2d(x, kernel_size=3, stride=1, padding=1)
+        branch1x1_2 = self.branch1x1_2(branch1x1_pool)
+
+        branch3x3_reduce = self.branch3x3_reduce(x)
+        branch3x3 = self.branch3x3(branch3x3_reduce)
+
+        branch3x3_reduce_2 = self.branch3x3_reduce_2(x)
+        branch3x3_2 = self.branch3x3_2(branch3x3_reduce_2)
+        branch3x3_3 = self.branch3x3_3(branch3x3_2)
+
+        return self.cat.cat([branch1x1, branch1x1_2, branch3x3, branch3x3_3], 1)
+
+
+class QuantFaceBoxes(nn.Module):
+    """FaceBoxes rewritten with quant/dequant stubs and fused modules.
+
+    The backbone and heads run in INT8, the reshape/concat/softmax of the
+    head outputs stays in float. Input is the mean-subtracted BGR image, as
+    for the float model.
+    """
+
+    def __init__(self, net):
+        super(QuantFaceBoxes, self).__init__()
+        self.phase = 'test'
+        self.num_classes = net.num_classes
+        self.quant = tq.QuantStub()
+        self.dequant = tq.DeQuantStub()
+
+        self.conv1 = _fuse_crelu(net.conv1)
+        self.conv2 = _fuse_crelu(net.conv2)
+        self.inception1 = QuantInception(net.inception1)
+        self.inception2 = QuantInception(net.inception2)
+        self.inception3 = QuantInception(net.inception3)
+        self.conv3_1 = _fuse_basic(net.conv3_1)
+        self.conv3_2 = _fuse_basic(net.conv3_2)
+        self.conv4_1 = _fuse_basic(net.conv4_1)
+        self.conv4_2 = _fuse_basic(net.conv4_2)
+        self.loc = copy.deepcopy(net.loc)
+        self.conf = copy.deepcopy(net.conf)
+
+    def forward(self, x):
+        detection_sources = list()
+        loc = list()
+        conf = list()
+
+        x = self.quant(x)
+        x = self.conv1(x)
+        x = F.max_pool2d(x, kernel_size=3, stride=2, padding=1)
+        x = self.conv2(x)
+        x = F.max_pool2d(x, kernel_size=3, stride=2, padding=1)
+        x = self.inception1(x)
+        x = self.inception2(x)
+        x = self.inception3(x)
+        detection_sources.append(x)
+
+        x = self.conv3_1(x)
+        x = self.conv3_2(x)
+        detection_sources.append(x)
+
+        x = self.conv4_1(x)
+        x = self.conv4_2(x)
+        detection_sources.append(x)
+
+        for (x, l, c) in zip(detection_sources, self.loc, self.conf):
+            loc.append(self.dequant(l(x)).permute(0, 2, 3, 1).contiguous())
+            conf.append(self.dequant(c(x)).permute(0, 2, 3, 1).contiguous())
+
+        loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
+        conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
+        return (loc.view(loc.size(0), -1, 4),
+                F.softmax(conf.view(conf.size(0), -1, self.num_classes), dim=-1))
+
+
+def default_backend():
+    engines = torch.backends.quantized.supported_engines
+    return 'fbgemm' if 'fbgemm' in engines else 'qnnpack'
+
+
+def prepare_quant(net, backend=None):
+    """Build QuantFaceBoxes from a float FaceBoxes and insert observers."""
+    backend = backend or default_backend()
+    torch.backends.quantized.engine = backend
+    qnet = QuantFaceBoxes(net.eval()).eval()
+    qnet.qconfig = tq.get_default_qconfig(backend)
+    return tq.prepare(qnet), backend
+
+
+def quantize_faceboxes(net, calib_inputs, backend=None):
+    """Calibrate on preprocessed inputs ([1, 3, H, W] tensors) and convert to INT8."""
+    qnet, backend = prepare_quant(net, backend)
+    with torch.no_grad():
+        for img in calib_inputs:
+            qnet(img)
+    qnet = tq.convert(qnet)
+    qnet.backend = backend
+    return qnet
+
+
+def save_quantized(qnet, path):
+    torch.save({'state_dict': qnet.state_dict(), 'backend': qnet.backend,
+                'num_classes': qnet.num_classes}, path)
+
+
+def load_quantized(path):
+    """Rebuild the INT8 module structure and load the calibrated weights/scales."""
+    ckpt = torch.load(path, map_location=lambda storage, loc: storage)
+    if ckpt['backend'] not in torch.backends.quantized.supported_engines:
+        raise RuntimeError('quantized engine {} is not supported on this host'.format(ckpt['backend']))
+    skeleton = FaceBoxes(phase='test', size=None, num_classes=ckpt['num_classes'])
+    with warnings.catch_warnings():
+        # the skeleton is never calibrated, its scales come from the state dict
+        warnings.simplefilter('ignore', UserWarning)
+        qnet, backend = prepare_quant(skeleton, ckpt['backend'])
+        qnet = tq.convert(qnet)
+    qnet.load_state_dict(ckpt['state_dict'])
+    qnet.backend = backend
+    qnet.eval()
+    return qnet
+
+
+def capture_frames(camera_id, num_frames, save_dir, interval=0.2):
+    """Grab calibration frames from one of our cameras and keep them on disk for later runs."""
+    import cv2
+
+    os.makedirs(save_dir, exist_ok=True)
+    cap = cv2.VideoCapture(camera_id)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+    frames = []
+    try:
+        while len(frames) < num_frames:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frame = cv2.flip(frame, 1)
+            cv2.imwrite(os.path.join(save_dir, 'calib_{:04d}.jpg'.format(len(frames))), frame)
+            frames.append(frame)
+            time.sleep(interval)
+    finally:
+        cap.release()
+    return frames
+
+
+def load_frames(calib_dir, max_frames=None):
+    import cv2
+
+    paths = sorted(glob.glob(os.path.join(calib_dir, '*.jpg')) + glob.glob(os.path.join(calib_dir, '*.png')))
+    return [cv2.imread(p) for p in paths[:max_frames]]
+
+
+def _iou(a, b):
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def accuracy_report(float_detector, int8_detector, frames, thresh=0.7, iou_thresh=0.5, name='int8'):
+    """Run both detectors on the same frames and summarize the regression of the INT8 model.
+
+    ``name`` labels the second detector in the report, the same report is used
+    for the reduced-precision float modes.
+    """
+    n_float = n_int8 = n_match = 0
+    ious, score_diffs, keyp_errs = [], [], []
+    t_float = t_int8 = 0.
+    for frame in frames:
+        t = time.perf_counter()
+        rf = float_detector.inference(frame, thresh)
+        t_float += time.perf_counter() - t
+        t = time.perf_counter()
+        rq = int8_detector.inference(frame, thresh)
+        t_int8 += time.perf_counter() - t
+        n_float += len(rf.dets)
+        n_int8 += len(rq.dets)
+        if len(rf.dets) and len(rq.dets):
+            iou = _iou(rf.dets['box'], rq.dets['box'])
+            best = iou.argmax(1)
+            for i, j in enumerate(best):
+                if iou[i, j] >= iou_thresh:
+                    n_match += 1
+                    ious.append(iou[i, j])
+                    score_diffs.append(abs(rf.dets['score'][i] - rq.dets['score'][j]))
+        if rf.hasTarget() and rq.hasTarget():
+            keyp_errs.append(np.hypot(*np.subtract(rf.keyp, rq.keyp)))
+    num = max(len(frames), 1)
+    report = {
+        'frames': len(frames),
+        'float_faces': n_float,
+        name + '_faces': n_int8,
+        'recall': n_match / n_float if n_float else 1.,
+        'precision': n_match / n_int8 if n_int8 else 1.,
+        'mean_iou': float(np.mean(ious)) if ious else 0.,
+        'mean_score_diff': float(np.mean(score_diffs)) if score_diffs else 0.,
+        'max_keyp_err_px': float(np.max(keyp_errs)) if keyp_errs else 0.,
+        'float_ms': t_float / num * 1000,
+        name + '_ms': t_int8 / num * 1000,
+    }
+    return report
+
+
+if __name__ == '__main__':
+    from src.face_detect_interface import FaceDetector
+
+    parser = argparse.ArgumentParser(description='FaceBoxes INT8 post-training quantization')
+    parser.add_argument('-m', '--trained_model', default='weights/FaceBoxes.pth', type=str)
+    parser.add_argument('--calib_dir', default='data/calib', type=str, help='calibration frames folder')
+    parser.add_argument('--camera', default=None, type=int, help='capture calibration frames from this camera')
+    parser.add_argument('--num_frames', default=200, type=int)
+    parser.add_argument('--infer_size', default='full', type=str, help='same as InferSize in setting.ini')
+    parser.add_argument('--backend', default=None, choices=['fbgemm', 'qnnpack', 'x86'])
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    if args.camera is not None:
+        frames = capture_frames(args.camera, args.num_frames, args.calib_dir)
+    else:
+        frames = load_frames(args.calib_dir, args.num_frames)
+    assert len(frames) > 0, 'no calibration frames'
+
+    float_detector = FaceDetector(args.trained_model, infer_size=args.infer_size)
+    qnet = quantize_faceboxes(float_detector.getNet(), (float_detector.makeInput(f) for f in frames), args.backend)
+    path = quantized_weight_path(args.trained_model)
+    save_quantized(qnet, path)
+    print('Saved INT8 model to {}'.format(path))
+
+    int8_detector = FaceDetector(args.trained_model, infer_size=args.infer_size, quantized=True)
+    report = accuracy_report(float_detector, int8_detector, frames)
+    print('INT8 accuracy report ({} frames):'.format(report.pop('frames')))
+    for k, v in report.items():
+        print('  {:<16s} {}'.format(k, v if isinstance(v, int) else '{:.4f}'.format(v)))
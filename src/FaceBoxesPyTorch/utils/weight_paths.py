@@ -0,0 +1,14 @@
+"""Names of the derived weight files, kept free of torch so they can be resolved without loading it."""
+import os
+
+
+def fused_weight_path(weight_path):
+    """weights/FaceBoxes.pth -> weights/FaceBoxes_fused.pth"""
+    root, ext = os.path.splitext(weight_path)
+    return root + '_fused' + ext
+
+
+def quantized_weight_path(weight_path):
+    """weights/FaceBoxes.pth -> weights/FaceBoxes_int8.pth"""
+    root, ext = os.path.splitext(weight_path)
+    return root + '_int8' + ext
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from PyQt5.QtCore import QThread, pyqtSignal
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+"""
+相机发现: 在后台线程中枚举相机,结果缓存,设备插拔时自动刷新,不阻塞界面
+    * Linux: 枚举/dev/video*,设备名从sysfs读取,用VIDIOC_QUERYCAP查询是否为采集设备
+      (只查询能力,不打开视频流,不会抢占其他进程正在使用的相机);轮询/dev检测插拔
+    * 其他平台: 并行地用VideoCapture试打开编号0~max_index的相机,只在请求刷新时进行
+"""
+
+CameraDevice = namedtuple("CameraDevice", ["index", "name", "path"])
+
+_DEV_DIR = "/dev"
+_SYSFS_DIR = "/sys/class/video4linux"
+_VIDEO_NODE = re.compile(r"^video(\d+)$")
+
+# struct v4l2_capability: driver[16] card[32] bus_info[32] version capabilities device_caps reserved[3]
+_V4L2_CAPABILITY = struct.Struct("16s32s32sIII3I")
+_VIDIOC_QUERYCAP = (2 << 30) | (_V4L2_CAPABILITY.size << 16) | (ord('V') << 8) | 0
+_V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+_V4L2_CAP_VIDEO_CAPTURE_MPLANE = 0x00001000
+_V4L2_CAP_DEVICE_CAPS = 0x80000000
+
+
+def _read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def query_v4l2(path):
+    """
+    查询V4L2设备能力,只打开设备节点,不启动视频流
+    :return: (设备名, 是否为采集设备),查询失败时为None
+    """
+    if fcntl is None:
+        return None
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        buf = bytearray(_V4L2_CAPABILITY.size)
+        fcntl.ioctl(fd, _VIDIOC_QUERYCAP, buf)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    _, card, _, _, caps, device_caps, *_ = _V4L2_CAPABILITY.unpack(buf)
+    # 同一个相机的多个节点(如UVC的元数据节点)共享capabilities,device_caps才是该节点自己的能力
+    if caps & _V4L2_CAP_DEVICE_CAPS:
+        caps = device_caps
+    return card.split(b"\0", 1)[0].decode(errors="replace"), bool(
+        caps & (_V4L2_CAP_VIDEO_CAPTURE | _V4L2_CAP_VIDEO_CAPTURE_MPLANE))
+
+
+def list_video_nodes():
+    """
+    :return: /dev下所有video节点的编号(升序)
+    """
+    try:
+        names = os.listdir(_DEV_DIR)
+    except OSError:
+        return []
+    return sorted(int(m.group(1)) for m in map(_VIDEO_NODE.match, names) if m)
+
+
+def scan_v4l2():
+    """
+    枚举Linux下的采集设备
+    :return: [CameraDevice]
+    """
+    devices = []
+    for idx in list_video_nodes():
+        path = os.path.join(_DEV_DIR, "video{}".format(idx))
+        name = _read_text(os.path.join(_SYSFS_DIR, "video{}".format(idx), "name"))
+        cap = query_v4l2(path)
+        if cap is not None:
+            name = name or cap[0]
+            if not cap[1]:
+                continue
+        elif _read_text(os.path.join(_SYSFS_DIR, "video{}".format(idx), "index")) not in (None, "0"):
+            # 无法查询能力(如没有权限)时,按sysfs的index过滤掉同一相机的附加节点
+            continue
+        devices.append(CameraDevice(idx, name or "video{}".format(idx), path))
+    return devices
+
+
+def _probe_index(idx):
+    cap = cv2.VideoCapture(idx)
+    try:
+        return cap.isOpened()
+    finally:
+        cap.release()
+
+
+def probe_indices(max_index=10, workers=4):
+    """
+    并行地试打开相机编号0~max_index-1
+    :return: [CameraDevice]
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        opened = list(pool.map(_probe_index, range(max_index)))
+    return [CameraDevice(i, "video{}".format(i), None) for i, ok in enumerate(opened) if ok]
+
+
+class CameraDiscovery(QThread):
+    devices_changed_sign = pyqtSignal(list)
+
+    def __init__(self, poll_interval=1.0, max_index=10):
+        """
+        :param poll_interval: Linux下轮询/dev检测插拔的间隔(秒)
+        :param max_index: 非Linux平台试打开的最大相机编号
+        """
+        super().__init__()
+        self._poll_interval = poll_interval
+        self._max_index = max_index
+        self._use_v4l2 = sys.platform.startswith("linux")
+        self._lock = threading.Lock()
+        self._devices = []
+        self._scanned = False
+        self._refresh = threading.Event()
+        self._refresh.set()
+
+    def getDevices(self):
+        """
+        缓存的设备列表,不会阻塞
+        :return: [CameraDevice]
+        """
+        with self._lock:
+            return list(self._devices)
+
+    def isScanned(self):
+        return self._scanned
+
+    def refresh(self):
+        """
+        请求后台线程重新扫描,扫描完成且设备有变化时发出devices_changed_sign
+        """
+        self._refresh.set()
+
+    def _scan(self):
+        if self._use_v4l2:
+            return scan_v4l2()
+        return probe_indices(self._max_index)
+
+    def run(self):
+        nodes = None
+        while True:
+            if self._use_v4l2:
+                # 节点列表变化(插拔)时才重新查询
+                cur = list_video_nodes()
+                if cur != nodes:
+                    nodes = cur
+                    self._refresh.set()
+            if self._refresh.wait(self._poll_interval):
+                self._refresh.clear()
+                t = time.perf_counter()
+                devices = self._scan()
+                with self._lock:
+                    changed = devices != self._devices or not self._scanned
+                    self._devices = devices
+                    self._scanned = True
+                if changed:
+                    print('Camera discovery: {} devices in {:.1f}ms'.format(len(devices),
+                                                                            (time.perf_counter() - t) * 1000))
+                    self.devices_changed_sign.emit(devices)
@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
+import threading
 from PyQt5.QtGui import QColor, QImage, QPixmap
 from PyQt5.QtWidgets import QWidget, QGraphicsDropShadowEffect
 from PyQt5.QtCore import pyqtSignal, QSettings, Qt
 from qfluentwidgets import setFont, MessageBox, FluentIcon
-import cv2
 from view.ui_camera import Ui_Camera
 
 from src.camera_manager import CameraManager
+from src.camera_discovery import CameraDiscovery
 from src.face_detect_interface import FaceDetector
+from src.process_detector import ProcessDetector
+from src.detect_overlay import fit_to_view, draw_result
 
 """
     调试相机界面
@@ -18,6 +21,7 @@ class CameraInterface(Ui_Camera, QWidget):
     update_frame_info_sign = pyqtSignal(int, int)
     update_kp_sign = pyqtSignal(int, int)
     clear_camview_sign = pyqtSignal()
+    precision_changed_sign = pyqtSignal(str)
 
     def __init__(self, face_detector, camera_manager, parent=None):
         super().__init__(parent=parent)
@@ -38,6 +42,7 @@ class CameraInterface(Ui_Camera, QWidget):
         setFont(self.devLabel, 13)
         setFont(self.whBodyLabel, 13)
         setFont(self.posLabel, 13)
+        setFont(self.precisionLabel, 13)
 
         self.refButton.setIcon(FluentIcon.SYNC)
 
@@ -58,6 +63,8 @@ class CameraInterface(Ui_Camera, QWidget):
 
         # 给个默认的相机
         self.chooseBox.addItem("相机 {}".format(self._settings.value("CamIdx")))
+        # 相机列表在后台线程中扫描,插拔时自动刷新
+        self._discovery = CameraDiscovery()
 
         # 设置控件阴影
         self.setShadowEffect(self.videoCardWidget)
@@ -66,8 +73,13 @@ class CameraInterface(Ui_Camera, QWidget):
 
         self.detButton.setEnabled(False)
 
+        # 推理精度, 可在运行时切换, CPU不支持的精度会自动回退到fp32
+        self.precisionBox.addItems(["auto", "fp32", "bf16", "fp16"])
+        self.precisionBox.setCurrentText(self.face_detector.getPrecision())
+
         # 连接槽函数
         self.connectSignSlots()
+        self._discovery.start()
 
     def stopCamera(self):
         if self._isCamOpen:
@@ -76,25 +88,22 @@ class CameraInterface(Ui_Camera, QWidget):
 
     def getAllCameraDrives(self):
         """
-        扫描当前设备下的所有可用相机
-        :return:
+        当前设备下的所有可用相机(后台扫描的缓存结果,不阻塞)
+        :return: [CameraDevice]
         """
-        camera_devices = []
-        for i in range(10):  # 假设最多检测10个设备
-            cap = cv2.VideoCapture(i)
-            if cap.isOpened():
-                camera_devices.append(i)
-                cap.release()
-        return camera_devices
+        return self._discovery.getDevices()
 
     def connectSignSlots(self):
         self.settingButton.clicked.connect(self.settingCamIdxSlot)
         self.camButton.clicked.connect(self.openCamSlot)
         self.detButton.clicked.connect(self.detSlot)
         self.refButton.clicked.connect(self.refCamDrivers)
+        self._discovery.devices_changed_sign.connect(self.updateCamDriversSlot)
+        self.precisionBox.currentTextChanged.connect(self.precisionSlot)
 
         self.update_frame_info_sign.connect(self.updateFrameInfoSlot)
         self.update_kp_sign.connect(self.updateKPSlot)
+        self.precision_changed_sign.connect(self.precisionChangedSlot)
 
         self.clear_camview_sign.connect(self.clearViewSlot, Qt.DirectConnection)
 
@@ -104,17 +113,74 @@ class CameraInterface(Ui_Camera, QWidget):
             return
         self.posLineEdit.setText("{},{}".format(x, y))
 
+    def precisionSlot(self, precision):
+        """
+        切换推理精度并保存到配置文件
+        创建新精度的引擎需要拷贝并折叠网络,在后台线程中进行,完成后由precisionChangedSlot更新界面
+        :param precision: auto/fp32/bf16/fp16
+        """
+        assert isinstance(self.face_detector, (FaceDetector, ProcessDetector))
+        self._settings.setValue("Precision", precision)
+        self.precisionBox.setEnabled(False)
+        threading.Thread(target=self._applyPrecision, args=(precision,), daemon=True).start()
+
+    def _applyPrecision(self, precision):
+        try:
+            precision = self.face_detector.setPrecision(precision)
+        except Exception as e:
+            print("Failed to set precision {}: {}".format(precision, e))
+            precision = self.face_detector.getPrecision()
+        self.precision_changed_sign.emit(precision)
+
+    def precisionChangedSlot(self, precision):
+        """
+        显示实际使用的精度(CPU不支持时回退的精度,或auto选中的精度)
+        :param precision: setPrecision的返回值
+        """
+        self.precisionBox.blockSignals(True)
+        self.precisionBox.setCurrentText(precision)
+        self.precisionBox.blockSignals(False)
+        self.precisionBox.setEnabled(True)
+        if self._isCamOpen:
+            self.updateDevInfo()
+
+    def updateDevInfo(self):
+        """
+        显示推理设备和当前实际使用的精度
+        """
+        self.devLineEdit.setText("cpu / {}".format(self.face_detector.getPrecision()))
+
     def refCamDrivers(self):
         """
         刷新相机设备数量
         :return:
         """
+        self._discovery.refresh()
+        if self._discovery.isScanned():
+            self.updateCamDriversSlot(self.getAllCameraDrives())
+
+    def updateCamDriversSlot(self, devices):
+        """
+        用扫描到的相机更新下拉框,尽量保持当前选中的相机
+        :param devices: [CameraDevice]
+        """
+        if self._isCamOpen:
+            # 相机打开时下拉框不可用,关闭后刷新时再更新
+            return
+        current = self.chooseBox.currentText().split(" ")[1] if self.chooseBox.count() else None
         self.chooseBox.clear()
-        for i in self.getAllCameraDrives():
-            self.chooseBox.addItem("相机 {}".format(i))
+        for dev in devices:
+            self.chooseBox.addItem("相机 {} {}".format(dev.index, dev.name))
+            if str(dev.index) == current:
+                self.chooseBox.setCurrentIndex(self.chooseBox.count() - 1)
 
     def updateFrameInfoSlot(self, w, h):
-        self.whLineEdit.setText("{}x{}".format(w, h))
+        fmt = self.camera_manager.getCaptureFormat()
+        if fmt is None:
+            self.whLineEdit.setText("{}x{}".format(w, h))
+        else:
+            # 显示驱动实际协商的格式
+            self.whLineEdit.setText("{}x{} {} {:.0f}fps".format(w, h, fmt["fourcc"], fmt["fps"]))
 
     def openCamSlot(self):
         assert isinstance(self.camera_manager, CameraManager)
@@ -135,7 +201,7 @@ class CameraInterface(Ui_Camera, QWidget):
             self.chooseBox.setEnabled(False)
             self.refButton.setEnabled(False)
             self.nameLineEdit.setText(self.chooseBox.currentText())
-            self.devLineEdit.setText("cpu")
+            self.updateDevInfo()
             self.update_frame_info_sign.emit(*self.camera_manager.getFrameWH())
             self.camButton.setText("关闭相机")
         else:
@@ -154,6 +220,9 @@ class CameraInterface(Ui_Camera, QWidget):
             self.update_kp_sign.emit(-1, -1)
             self.camButton.setText("开启相机")
         self._isCamOpen = not self._isCamOpen
+        if not self._isCamOpen and self._discovery.isScanned():
+            # 打开相机期间的插拔在关闭后补上
+            self.updateCamDriversSlot(self.getAllCameraDrives())
 
     def clearViewSlot(self):
         self.camView.setPixmap(
@@ -161,18 +230,24 @@ class CameraInterface(Ui_Camera, QWidget):
 
     def updateFrame(self, frame):
         try:
-            _frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # opencv读取的bgr格式图片转换成rgb格式
+            # 网络和显示都直接使用opencv的bgr图像,不再做颜色转换
+            _frame = frame
             if self._isDetOpen:
-                assert isinstance(self.face_detector, FaceDetector)
-                res, keyp, _frame = self.face_detector.inference(_frame)
-                if keyp:
+                assert isinstance(self.face_detector, (FaceDetector, ProcessDetector))
+                res = self.face_detector.inference(_frame)
+                if res.hasTarget():
+                    keyp = res.keyp
                     self.update_kp_sign.emit(int(keyp[0]), int(keyp[1]))
                 else:
                     self.update_kp_sign.emit(-1, -1)
             else:
                 self.update_kp_sign.emit(-1, -1)
+            # 帧是帧缓冲池的只读视图,缩放到显示分辨率的新图像上再显示,叠加层直接画在上面
+            _frame, r = fit_to_view(_frame, self.camView.width(), self.camView.height())
+            if self._isDetOpen:
+                draw_result(_frame, res, r)
             _image = QImage(_frame[:], _frame.shape[1], _frame.shape[0], _frame.shape[1] * 3,
-                            QImage.Format_RGB888)
+                            QImage.Format_BGR888)
             _out = QPixmap(_image)
             if self._isCamOpen:
                 view_size = self.camView.size()
@@ -189,6 +264,9 @@ class CameraInterface(Ui_Camera, QWidget):
         except Exception as e:
             print(e)
             exec(0)
+        finally:
+            # 处理完这一帧再要下一帧
+            self.camera_manager.requestFrame()
     # def resizeEvent(self, event):
     #     pass
 
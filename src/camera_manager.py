@@ -3,22 +3,85 @@ import cv2
 import numpy as np
 from PyQt5.QtCore import QThread, pyqtSignal, QMutex
 import time
+import threading
+from src.frame_pool import FramePool
+from src.frame_exchange import FrameExchange
 
 """
 CameraManager 用于管理相机，获取图像帧
+    采集和镜像都写入帧缓冲池中的缓冲区,发出的是只读视图,
+    槽函数需要在返回后继续使用该帧时,通过getFrameHandle().acquire()持有,用完release
+    不使用信号的消费者(录像/无界面循环等)通过waitForFrame按序号阻塞等待新的原图帧
+
+    grab模式: 采集线程不停地grab()把驱动缓冲中的帧取空,只有消费者requestFrame()要帧时才retrieve()解码,
+    推理比相机慢时拿到的总是最新的帧,没人要的帧也不会被解码
+
+    采集格式(分辨率/帧率/FOURCC/后端/驱动缓冲)在connect时设置,并读回驱动实际协商的结果
 """
 
+# 后端名称到OpenCV API的映射,也可以写成CAP_V4L2这样的常量名
+CAPTURE_BACKENDS = {"auto": cv2.CAP_ANY, "v4l2": cv2.CAP_V4L2, "gstreamer": cv2.CAP_GSTREAMER,
+                    "dshow": cv2.CAP_DSHOW, "msmf": cv2.CAP_MSMF, "ffmpeg": cv2.CAP_FFMPEG}
+
+
+def resolve_backend(backend):
+    """
+    :param backend: 后端名称/CAP_*常量名/GStreamer管道字符串
+    :return: (OpenCV API, GStreamer管道字符串或None)
+    """
+    backend = str(backend or "auto").strip()
+    if "!" in backend:
+        return cv2.CAP_GSTREAMER, backend
+    name = backend.lower()
+    if name.startswith("cap_"):
+        name = name[4:]
+    if name not in CAPTURE_BACKENDS:
+        raise ValueError("unknown capture backend {}".format(backend))
+    return CAPTURE_BACKENDS[name], None
+
+
+def decode_fourcc(value):
+    value = int(value)
+    return "".join(chr((value >> 8 * i) & 0xFF) for i in range(4)).strip("\x00 ")
+
 
 class CameraManager(QThread):
     update_frame_sign = pyqtSignal(np.ndarray)
 
-    def __init__(self):
+    def __init__(self, grab_mode=True, width=1280, height=720, fps=0, fourcc="", backend="auto", buffer_size=1):
+        """
+        :param grab_mode: 使用grab/retrieve按需解码最新帧,False时每帧都read
+        :param width: 采集宽度
+        :param height: 采集高度
+        :param fps: 采集帧率,0为驱动默认
+        :param fourcc: 像素格式,如MJPG/YUYV,为空时使用驱动默认
+        :param backend: 采集后端 auto/v4l2/gstreamer/dshow/msmf/ffmpeg,或GStreamer管道字符串(此时忽略相机编号)
+        :param buffer_size: 驱动缓冲的帧数,0为驱动默认
+        """
         super().__init__()
         self._cap = None
+        self._grab_mode = grab_mode
+        self._request_format = dict(width=int(width), height=int(height), fps=float(fps),
+                                    fourcc=str(fourcc or "").strip().upper(), backend=backend,
+                                    buffer_size=int(buffer_size))
+        # 驱动实际协商的采集格式,connect后有效
+        self._format = None
+        # 消费者已经准备好接收下一帧
+        self._demand = threading.Event()
+        # grab的帧数和实际解码的帧数
+        self._grabbed = 0
+        self._decoded = 0
         self._current_frame = np.ndarray([720, 1280, 3], dtype=np.uint8)
+        self._pool = FramePool(8)
+        # 最近一帧原图经帧交换发布,带序号和采集时间
+        self._exchange = FrameExchange()
+        # 正在发出的镜像帧的句柄
+        self._frame_handle = None
         self._mutex = QMutex()
         self._isConnect = False
         self._cam_idx = None
+        # 当前帧的采集时间(time.perf_counter),在发出帧信号前更新
+        self._frame_time = time.perf_counter()
         self.start()
 
     def getCameraIndex(self):
@@ -35,10 +98,7 @@ class CameraManager(QThread):
         if self._cap is not None:
             return False, "相机{}已启动.".format(self._cam_idx)
         try:
-            self._cap = cv2.VideoCapture(camera_id)
-            # 原生分辨率为640*480，提升到1280*720
-            self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-            self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+            self._cap = self._openCapture(camera_id)
         except Exception as e:
             self._cap = None
             return False, "编号为 {} 的相机启动异常,报错信息 {}.".format(camera_id, e)
@@ -46,14 +106,103 @@ class CameraManager(QThread):
             self._cap = None
             del self._cap
             return False, "编号为 {} 的相机不能开启,请检查是否连接上设备.".format(camera_id)
+        self._format = self._readFormat()
+        self._printFormat()
+        # 按实际分辨率准备帧缓冲
+        self._current_frame = np.zeros((self._format["height"], self._format["width"], 3), dtype=np.uint8)
+        self._grabbed = self._decoded = 0
+        # 第一帧不需要等消费者请求
+        self._demand.set()
         self._isConnect = True
         self._cam_idx = camera_id
         return True, ""
 
+    def _openCapture(self, camera_id):
+        req = self._request_format
+        api, pipeline = resolve_backend(req["backend"])
+        if pipeline is not None:
+            # 管道中已经指定了格式,不再设置
+            return cv2.VideoCapture(pipeline, api)
+        cap = cv2.VideoCapture(camera_id, api)
+        if not cap.isOpened():
+            return cap
+        # V4L2需要先设置像素格式再设置分辨率,否则会按原格式协商分辨率
+        if req["fourcc"]:
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*req["fourcc"].ljust(4)[:4]))
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, req["width"])
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, req["height"])
+        if req["fps"] > 0:
+            cap.set(cv2.CAP_PROP_FPS, req["fps"])
+        if req["buffer_size"] > 0:
+            # 不支持的后端会忽略
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, req["buffer_size"])
+        return cap
+
+    def _readFormat(self):
+        """
+        读回驱动实际协商的采集格式
+        """
+        cap = self._cap
+        try:
+            backend = cap.getBackendName()
+        except cv2.error:
+            backend = ""
+        return dict(width=int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), height=int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    fps=float(cap.get(cv2.CAP_PROP_FPS)), fourcc=decode_fourcc(cap.get(cv2.CAP_PROP_FOURCC)),
+                    backend=backend, buffer_size=int(cap.get(cv2.CAP_PROP_BUFFERSIZE)))
+
+    def _printFormat(self):
+        fmt, req = self._format, self._request_format
+        print('Camera {}: {}x{} @ {:.1f}fps {} buffer {}'.format(fmt["backend"], fmt["width"], fmt["height"],
+                                                                 fmt["fps"], fmt["fourcc"] or "-", fmt["buffer_size"]))
+        differs = [k for k in ("width", "height", "fourcc") if req[k] and fmt[k] != req[k]]
+        if req["fps"] > 0 and abs(fmt["fps"] - req["fps"]) > 0.5:
+            differs.append("fps")
+        if differs:
+            print('Camera format differs from requested: {}'.format(
+                ", ".join("{} {} -> {}".format(k, req[k], fmt[k]) for k in differs)))
+
+    def getCaptureFormat(self):
+        """
+        驱动实际协商的采集格式 {width, height, fps, fourcc, backend, buffer_size},未连接时为None
+        """
+        return self._format
+
     def getFPS(self):
         fps = self._cap.get(cv2.CAP_PROP_FPS)
         return fps
 
+    def getFrameTime(self):
+        """
+        最近一帧的采集时间,槽函数以DirectConnection连接时与收到的帧对应
+        """
+        return self._frame_time
+
+    def waitForFrame(self, after_seq=0, timeout=None):
+        """
+        等待序号大于after_seq的原图帧(未镜像)
+        :param after_seq: 上一次处理的帧序号
+        :param timeout: 超时时间(秒),None为一直等待
+        :return: FramePacket(seq, time, frame),用完release;超时或相机断开时为None
+        """
+        self.requestFrame()
+        return self._exchange.waitForFrame(after_seq, timeout)
+
+    def getFrameSeq(self):
+        """
+        最新一帧的序号
+        """
+        return self._exchange.getSeq()
+
+    def getFrameHandle(self):
+        """
+        正在发出的帧的句柄,只在以DirectConnection连接的槽函数中有效
+        """
+        return self._frame_handle
+
+    def getFramePool(self):
+        return self._pool
+
     def getFrameWH(self):
         return self._current_frame.shape[1], self._current_frame.shape[0]
 
@@ -66,39 +215,113 @@ class CameraManager(QThread):
                 time.sleep(0.05)
                 continue
             self._mutex.lock()
-            ret, frame = self._cap.read()
-            if ret:
-                self._current_frame = frame
-                self.update_frame_sign.emit(cv2.flip(frame, 1))
+            if self._grab_mode:
+                ok = self._grabFrame()
             else:
-                self.update_frame_sign.emit(cv2.flip(self._current_frame, 1))
+                self._readFrame()
+                ok = True
             self._mutex.unlock()
+            if not ok:
+                time.sleep(0.01)
+
+    def _readFrame(self):
+        handle = self._pool.get(self._current_frame.shape)
+        ret, frame = self._cap.read(handle.buffer)
+        self._frame_time = time.perf_counter()
+        self._decoded += 1
+        self._publishFrame(handle, ret, frame)
+
+    def _grabFrame(self):
+        """
+        取出驱动缓冲中的一帧,有消费者在等时才解码并发出
+        :return: grab是否成功
+        """
+        if not self._cap.grab():
+            return False
+        t = time.perf_counter()
+        self._grabbed += 1
+        if not self._demand.is_set():
+            return True
+        self._demand.clear()
+        handle = self._pool.get(self._current_frame.shape)
+        ret, frame = self._cap.retrieve(handle.buffer)
+        self._frame_time = t
+        self._decoded += 1
+        self._publishFrame(handle, ret, frame)
+        return True
+
+    def _publishFrame(self, handle, ret, frame):
+        if ret:
+            if frame is not handle.buffer:
+                # 分辨率与缓冲区不一致时read会另外分配,下一帧按新的尺寸取缓冲区
+                handle.release()
+                handle = self._pool.get(frame.shape)
+                np.copyto(handle.buffer, frame)
+            self._current_frame = handle.frame
+            self._exchange.publish(handle, self._frame_time)
+        else:
+            handle.release()
+        self._emitFrame()
+
+    def requestFrame(self):
+        """
+        消费者准备好处理下一帧时调用,grab模式下下一次grab到的帧会被解码并发出
+        """
+        self._demand.set()
+
+    def getCaptureStats(self):
+        """
+        :return: (grab的帧数, 解码的帧数)
+        """
+        return self._grabbed, self._decoded
+
+    def _emitFrame(self):
+        """
+        把最近一帧镜像到池中的另一个缓冲区并发出,发出后释放采集线程持有的引用
+        """
+        frame = self._current_frame
+        self._frame_handle = self._pool.get(frame.shape)
+        cv2.flip(frame, 1, self._frame_handle.buffer)
+        self.update_frame_sign.emit(self._frame_handle.frame)
+        self._frame_handle.release()
+        self._frame_handle = None
 
     def disconnect(self):
         if self._cap is None:
             return
         self._isConnect = False
+        # 唤醒等待新帧的消费者
+        self._exchange.close()
         self._cap.release()
         del self._cap
         self._cap = None
 
     def getFrame(self):
-        return self._current_frame
+        """
+        最近一帧原图的拷贝,需要按帧处理时使用waitForFrame
+        """
+        packet = self._exchange.latest()
+        if packet is None:
+            return self._current_frame.copy()
+        with packet:
+            return packet.frame.copy()
 
 
 if __name__ == '__main__':
-    import time
-
     camera_man = CameraManager()
     camera_man.connect(1)
+    seq = 0
     while True:
-        img=camera_man.getFrame()
-        cv2.imshow("qwe",img)
-        key =cv2.waitKey(1)
-        if key==27:
+        # 阻塞等待新帧,不会重复处理同一帧
+        packet = camera_man.waitForFrame(seq, timeout=1.)
+        if packet is None:
+            continue
+        if packet.seq - seq > 1:
+            print("dropped {} frames".format(packet.seq - seq - 1))
+        seq = packet.seq
+        with packet:
+            cv2.imshow("qwe", packet.frame)
+        key = cv2.waitKey(1)
+        if key == 27:
             print("press esc exit")
             break
-    # time.sleep(0.5)
-    # print(type(camera_man.getFrame()))
-    # cv2.imwrite("../test/test.jpg", camera_man.getFrame())
-    # camera_man.disconnect()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import os
+import copy
+import json
+import time
+import platform
+import threading
+import torch
+from torch.utils import mkldnn as mkldnn_utils
+from src.detect_engine import ENGINE_CACHE_DIR
+from src.FaceBoxesPyTorch.utils.fuse_model import fuse_faceboxes
+
+"""
+CPU推理参数自动调优
+    在实际的输入分辨率上对比 线程数 x 内存格式(NCHW/channels_last) x oneDNN预打包权重 的前向耗时,
+    最优配置按 主机/CPU型号/torch版本 持久化,之后启动直接应用,不再重复测试
+"""
+
+TUNE_CACHE_PATH = os.path.join(ENGINE_CACHE_DIR, "cpu_tune.json")
+
+# 内存格式候选: 默认NCHW / channels_last / oneDNN预打包权重(mkldnn)
+LAYOUTS = ("contiguous", "channels_last", "mkldnn")
+
+
+def cpu_model():
+    """
+    CPU型号,读不到时使用platform给出的处理器信息
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("model name", "Hardware")):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def host_key():
+    """
+    调优结果的主机键,换机器/换CPU/升级torch后会重新调优
+    """
+    return "{}|{}|{}|torch {}".format(platform.node(), cpu_model(), os.cpu_count(), torch.__version__)
+
+
+def thread_candidates():
+    """
+    线程数候选: 1,2,4,...以及全部逻辑核
+    """
+    n = os.cpu_count() or 1
+    res = set([n])
+    t = 1
+    while t < n:
+        res.add(t)
+        t *= 2
+    return sorted(res)
+
+
+def apply_layout(net, layout, float_net=True):
+    """
+    按内存格式准备网络
+    :param net: eval模式的网络
+    :param layout: contiguous/channels_last/mkldnn
+    :param float_net: 是否为未融合的float网络,mkldnn需要先折叠BN
+    :return: 网络, contiguous/channels_last时原地转换,mkldnn时返回转换后的副本
+    """
+    if layout == "channels_last":
+        return net.to(memory_format=torch.channels_last)
+    if layout == "mkldnn":
+        net = copy.deepcopy(net)
+        if float_net:
+            net = fuse_faceboxes(net, mean=None)
+        return mkldnn_utils.to_mkldnn(net)
+    return net.to(memory_format=torch.contiguous_format)
+
+
+def _time_forward(net, img, repeat):
+    net(img)
+    t = time.perf_counter()
+    for _ in range(repeat):
+        net(img)
+    return (time.perf_counter() - t) / repeat * 1000
+
+
+def autotune(net, shape, layouts=LAYOUTS, float_net=True, dtype=torch.float32, repeat=3):
+    """
+    在给定输入尺寸上测试所有候选配置
+    :param net: eval模式的网络,不会被修改
+    :param shape: 网络输入形状 [1, 3, h, w]
+    :param layouts: 参与测试的内存格式
+    :param float_net: 是否为未融合的float网络
+    :param dtype: 网络的参数类型,输入按该类型生成
+    :param repeat: 每个配置的计时次数
+    :return: 最优配置 {"threads", "layout", "ms"}
+    """
+    old_threads = torch.get_num_threads()
+    img = (torch.randint(0, 256, shape, generator=torch.Generator().manual_seed(0)).float() - 117).to(dtype)
+    best = None
+    try:
+        with torch.no_grad():
+            for layout in layouts:
+                try:
+                    candidate = apply_layout(copy.deepcopy(net), layout, float_net)
+                except Exception as e:
+                    print("Skip layout {} ({})".format(layout, e))
+                    continue
+                x = img.contiguous(memory_format=torch.channels_last) if layout == "channels_last" else img
+                for threads in thread_candidates():
+                    torch.set_num_threads(threads)
+                    try:
+                        ms = _time_forward(candidate, x, repeat)
+                    except Exception as e:
+                        print("Skip layout {} ({})".format(layout, e))
+                        break
+                    print("  threads {:<3d} {:<14s} {:.1f}ms".format(threads, layout, ms))
+                    if best is None or ms < best["ms"]:
+                        best = {"threads": threads, "layout": layout, "ms": ms}
+    finally:
+        torch.set_num_threads(old_threads)
+    return best
+
+
+class CpuTuner(object):
+    """
+    管理调优结果的持久化,同一主机上每个 输入尺寸/网络变体 只调优一次
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, path=TUNE_CACHE_PATH):
+        self._path = path
+        self._host = host_key()
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, net, shape, variant="", layouts=LAYOUTS, float_net=True, dtype=torch.float32, activity=None):
+        """
+        获取配置,没有记录时当场调优并保存
+        测试期间有推理在同时运行时计时不可信,结果只用于本次运行,不保存,下次启动重新调优
+        :param net: eval模式的网络
+        :param shape: 网络输入形状 [1, 3, h, w]
+        :param variant: 网络变体标记(fused/int8/执行引擎/精度等)
+        :param dtype: 网络的参数类型
+        :param activity: 返回推理计数的函数,测试前后计数不同说明测试期间有推理在运行
+        :return: {"threads", "layout", "ms"}
+        """
+        key = "{}x{}|{}".format(shape[3], shape[2], variant or "float")
+        with self._lock:
+            cache = self._load()
+            config = cache.get(self._host, {}).get(key)
+            if config is not None and config.get("layout") in layouts:
+                return config
+            print("Tuning CPU runtime for input {}x{} on {} ...".format(shape[3], shape[2], cpu_model()))
+            count = activity() if activity is not None else None
+            config = autotune(net, shape, layouts, float_net, dtype)
+            if config is None:
+                return None
+            print("Best CPU runtime config: {} threads, {} ({:.1f}ms)".format(
+                config["threads"], config["layout"], config["ms"]))
+            if activity is not None and activity() != count:
+                print("Inference was running during tuning, config is used for this run only")
+                return config
+            cache.setdefault(self._host, {})[key] = config
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            with open(self._path, "w") as f:
+                json.dump(cache, f, indent=2)
+            return config
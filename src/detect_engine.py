@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import hashlib
+import importlib.util
+import cv2
+import numpy as np
+
+"""
+检测网络的执行引擎
+    * eager: 直接调用nn.Module
+    * script: TorchScript trace + freeze + optimize_for_inference,按输入尺寸编译并缓存到磁盘
+    * compile: torch.compile,编译产物由inductor缓存到同一目录
+    * opencv: 按输入尺寸导出ONNX并用cv2.dnn执行,导出文件同样缓存到磁盘
+编译失败时自动回退到eager
+
+推理精度: fp32/bf16/fp16,降低精度时网络权重和输入转换为对应类型,输出转回float32,后处理不受影响
+CPU不支持原生bf16/fp16指令时自动回退到fp32
+
+opencv引擎的推理路径只用numpy和cv2,torch在导出ONNX或回退到eager时才导入
+"""
+
+ENGINE_CACHE_DIR = "weights/cache"
+
+PRECISIONS = ("fp32", "bf16", "fp16")
+
+# 具备原生低精度计算能力的CPU特性(/proc/cpuinfo中的flags/Features)
+_NATIVE_CPU_FLAGS = {
+    "bf16": ("avx512_bf16", "amx_bf16", "bf16"),
+    "fp16": ("avx512_fp16", "amx_fp16", "asimdhp"),
+}
+
+
+def torch_dtype(precision):
+    """
+    :param precision: fp32/bf16/fp16
+    :return: 对应的torch数据类型
+    """
+    import torch
+    return {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}[precision]
+
+
+def torch_version():
+    """
+    torch版本(编译缓存键的一部分),torch还没有导入时读取安装目录下的torch/version.py,不导入torch
+    """
+    if "torch" in sys.modules:
+        return sys.modules["torch"].__version__
+    spec = importlib.util.find_spec("torch")
+    if spec is None or not spec.submodule_search_locations:
+        return ""
+    try:
+        with open(os.path.join(spec.submodule_search_locations[0], "version.py")) as f:
+            m = re.search(r"^__version__\s*=\s*['\"]([^'\"]+)['\"]", f.read(), re.M)
+    except OSError:
+        return ""
+    return m.group(1) if m else ""
+
+
+def resolve_net(net):
+    """
+    :param net: 网络,或返回网络的函数(延迟加载)
+    :return: 网络
+    """
+    return net if hasattr(net, "forward") else net()
+
+
+def file_digest(path):
+    """
+    计算权重文件的哈希,作为编译缓存键的一部分
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _cpu_flags():
+    """
+    读取CPU特性,非linux系统返回None
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return None
+
+
+def native_precisions():
+    """
+    当前CPU原生支持的推理精度
+    :return: 例如 ["fp32", "bf16"]
+    """
+    flags = _cpu_flags()
+    res = ["fp32"]
+    for name, cpu_flags in _NATIVE_CPU_FLAGS.items():
+        if flags is not None:
+            supported = any(f in flags for f in cpu_flags)
+        else:
+            # 读不到cpuinfo时以oneDNN自身的判断为准
+            import torch
+            check = getattr(torch.ops.mkldnn, "_is_mkldnn_{}_supported".format(name), None)
+            try:
+                supported = bool(check()) if check is not None else False
+            except RuntimeError:
+                supported = False
+        if supported:
+            res.append(name)
+    return res
+
+
+def resolve_precision(name):
+    """
+    将配置的精度解析为实际可用的精度
+    :param name: auto/fp32/bf16/fp16, auto在支持时使用bf16
+    :return: 实际使用的精度
+    """
+    name = (name or "fp32").lower()
+    native = native_precisions()
+    if name == "auto":
+        return "bf16" if "bf16" in native else "fp32"
+    if name not in PRECISIONS:
+        raise ValueError("unknown precision {}".format(name))
+    if name not in native:
+        print("CPU has no native {} support, fallback to fp32".format(name))
+        return "fp32"
+    return name
+
+
+class EagerEngine(object):
+    name = "eager"
+
+    def __init__(self, net):
+        import torch
+        self._net = net
+        self._from_numpy = torch.from_numpy
+
+    def __call__(self, img):
+        if isinstance(img, np.ndarray):
+            # opencv引擎回退时输入为numpy缓冲区
+            img = self._from_numpy(img)
+        return self._net(img)
+
+
+class TorchScriptEngine(object):
+    name = "script"
+
+    def __init__(self, net, weight_path, cache_dir=ENGINE_CACHE_DIR, tag=""):
+        """
+        :param net: eval模式的网络
+        :param weight_path: 网络权重文件,其哈希与torch版本、输入尺寸共同决定缓存文件
+        :param cache_dir: 编译产物缓存目录
+        :param tag: 区分同一权重的不同网络变体(如融合模型)
+        """
+        self._net = net
+        self._cache_dir = cache_dir
+        self._key = "{}|{}|{}".format(file_digest(weight_path), torch_version(), tag)
+        self._modules = {}
+
+    def _cachePath(self, shape):
+        key = "{}|{}".format(self._key, "x".join(map(str, shape)))
+        return os.path.join(self._cache_dir, "FaceBoxes_{}.pt".format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+    def _build(self, img):
+        import torch
+        path = self._cachePath(tuple(img.shape))
+        if os.path.exists(path):
+            print("Loading compiled model from {}".format(path))
+            module = torch.jit.load(path, map_location="cpu")
+        else:
+            print("Compiling model for input {} ...".format(tuple(img.shape)))
+            module = torch.jit.trace(self._net, img, check_trace=False)
+            module = torch.jit.freeze(module.eval())
+            os.makedirs(self._cache_dir, exist_ok=True)
+            torch.jit.save(module, path)
+        # optimize_for_inference生成的mkldnn预打包常量不能序列化,缓存冻结后的模型,加载后再优化
+        return torch.jit.optimize_for_inference(module)
+
+    def __call__(self, img):
+        shape = tuple(img.shape)
+        module = self._modules.get(shape)
+        if module is None:
+            module = self._modules[shape] = self._build(img)
+        return module(img)
+
+
+class CompileEngine(object):
+    name = "compile"
+
+    def __init__(self, net, cache_dir=ENGINE_CACHE_DIR):
+        # inductor自身按图和torch版本缓存编译产物,缓存目录与script引擎放在一起
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(os.path.join(cache_dir, "inductor")))
+        import torch
+        self._module = torch.compile(net, dynamic=False)
+
+    def __call__(self, img):
+        return self._module(img)
+
+
+class OpenCVEngine(object):
+    name = "opencv"
+
+    def __init__(self, net, weight_path, cache_dir=ENGINE_CACHE_DIR, tag=""):
+        """
+        :param net: 网络,或返回网络的函数,只在需要导出新尺寸的ONNX时才调用
+        """
+        self._net = net
+        self._cache_dir = cache_dir
+        self._key = "{}|{}|{}".format(file_digest(weight_path), torch_version(), tag)
+        self._dnns = {}
+
+    def _cachePath(self, shape):
+        key = "{}|{}".format(self._key, "x".join(map(str, shape)))
+        return os.path.join(self._cache_dir, "FaceBoxes_{}.onnx".format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+    def _build(self, img):
+        # batch维固定为1导出,batch推理逐张执行
+        path = self._cachePath((1,) + tuple(img.shape[1:]))
+        if not os.path.exists(path):
+            print("Exporting ONNX model for input {} ...".format(tuple(img.shape[1:])))
+            from src.FaceBoxesPyTorch.utils.export_onnx import export_onnx
+            export_onnx(resolve_net(self._net), path, tuple(img.shape[2:]))
+        print("Loading ONNX model from {}".format(path))
+        return cv2.dnn.readNetFromONNX(path)
+
+    def __call__(self, img):
+        shape = tuple(img.shape[1:])
+        dnn = self._dnns.get(shape)
+        if dnn is None:
+            dnn = self._dnns[shape] = self._build(img)
+        blob = img if isinstance(img, np.ndarray) else img.numpy()
+        outs = []
+        for i in range(blob.shape[0]):
+            dnn.setInput(blob[i:i + 1])
+            outs.append(dnn.forward(["loc", "conf"]))
+        if len(outs) == 1:
+            return outs[0][0], outs[0][1]
+        return np.concatenate([o[0] for o in outs]), np.concatenate([o[1] for o in outs])
+
+
+class PrecisionEngine(object):
+    """
+    包装低精度网络的执行引擎: 输入转换为网络精度,输出转回float32
+    """
+
+    def __init__(self, engine, precision):
+        self._engine = engine
+        self._dtype = torch_dtype(precision)
+        self.precision = precision
+
+    @property
+    def name(self):
+        return self._engine.name
+
+    def __call__(self, img):
+        loc, conf = self._engine(img.to(self._dtype))
+        return loc.float(), conf.float()
+
+
+class FallbackEngine(object):
+    """
+    包装编译引擎,任何一次编译/执行失败后永久回退到eager
+    """
+
+    def __init__(self, engine, net):
+        self._engine = engine
+        # 回退时才创建eager引擎,net可以是延迟加载的函数
+        self._net = net
+        self._eager = None
+        self.name = engine.name
+
+    def __call__(self, img):
+        if self._engine is not None:
+            try:
+                return self._engine(img)
+            except Exception as e:
+                print("{} engine failed ({}), fallback to eager".format(self.name, e))
+                self._engine = None
+                self._eager = EagerEngine(resolve_net(self._net))
+                self.name = self._eager.name
+        return self._eager(img)
+
+
+def create_engine(name, net, weight_path, tag=""):
+    """
+    创建执行引擎
+    :param name: eager/script/compile/opencv
+    :param net: eval模式的网络,opencv引擎可以传入返回网络的函数(延迟加载)
+    :param weight_path: 实际加载的权重文件
+    :param tag: 网络变体标记
+    :return: 可调用对象 engine(img) -> (loc, conf)(torch张量或numpy数组),name属性为实际使用的引擎
+    """
+    name = (name or "eager").lower()
+    if name != "opencv":
+        net = resolve_net(net)
+    if name == "eager":
+        return EagerEngine(net)
+    try:
+        if name == "script":
+            engine = TorchScriptEngine(net, weight_path, tag=tag)
+        elif name == "compile":
+            import torch
+            if not hasattr(torch, "compile"):
+                raise RuntimeError("torch.compile is not available in torch {}".format(torch.__version__))
+            engine = CompileEngine(net)
+        elif name == "opencv":
+            engine = OpenCVEngine(net, weight_path, tag=tag)
+        else:
+            raise ValueError("unknown engine {}".format(name))
+    except Exception as e:
+        print("Create {} engine failed ({}), fallback to eager".format(name, e))
+        return EagerEngine(resolve_net(net))
+    return FallbackEngine(engine, net)
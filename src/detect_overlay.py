@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import cv2
+
+"""
+检测结果的叠加绘制,与推理解耦,仅在需要显示检测画面时调用
+颜色均为bgr顺序
+"""
+
+
+def fit_to_view(image, view_w, view_h):
+    """
+    将图像按比例缩放到显示控件大小,叠加层直接画在显示分辨率的图像上
+    :param image: 原图
+    :param view_w: 显示控件宽
+    :param view_h: 显示控件高
+    :return: (缩放后的新图像, 缩放比例)
+    """
+    h, w = image.shape[:2]
+    r = min(view_w / w, view_h / h)
+    if r >= 1 or r <= 0:
+        return image.copy(), 1.0
+    return cv2.resize(image, (max(1, int(w * r)), max(1, int(h * r))), interpolation=cv2.INTER_AREA), r
+
+
+def draw_result(image, result, r=1.0):
+    """
+    在图像上绘制检测结果: 非目标人脸画细框,目标人脸画框/分数/中心十字
+    :param image: 待绘制的图像,会被原地修改
+    :param result: DetectResult
+    :param r: 结果坐标到image的缩放比例
+    :return: image
+    """
+    for i, rec in enumerate(result.dets):
+        if i == result.target:
+            continue
+        b = [int(v * r) for v in rec['box']]
+        cv2.rectangle(image, (b[0], b[1]), (b[2], b[3]), (150, 150, 150), 1)
+
+    if not result.hasTarget():
+        return image
+
+    text = "{:.4f}".format(result.score)
+    if result.id >= 0:
+        text = "#{} {}".format(result.id, text)
+    b = [int(v * r) for v in result.box]
+    cv2.rectangle(image, (b[0], b[1]), (b[2], b[3]), (150, 255, 150), 2)
+    cx = b[0]
+    cy = b[1] + 12
+    cv2.putText(image, text, (cx, cy),
+                cv2.FONT_HERSHEY_DUPLEX, 0.5, (255, 255, 255))
+
+    keyp = [v * r for v in result.keyp]
+    p = 20
+    cv2.line(image, (int(keyp[0] - p), int(keyp[1])), (int(keyp[0] + p), int(keyp[1])), (100, 70, 0), 2)
+    cv2.line(image, (int(keyp[0]), int(keyp[1] - p)), (int(keyp[0]), int(keyp[1] + p)), (100, 70, 0), 2)
+    return image
+
+
+def draw_center_lines(image):
+    """
+    绘制画面中心线
+    """
+    h = image.shape[0]
+    w = image.shape[1]
+    cv2.line(image, (0, int(h / 2)), (w, int(h / 2)), (0, 0, 255), 1)
+    cv2.line(image, (int(w / 2), 0), (int(w / 2), h), (255, 0, 0), 1)
+    return image
@@ -1,127 +1,643 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
-import torch
-import torch.backends.cudnn as cudnn
+import os
+import copy
+import threading
 import numpy as np
+from collections import OrderedDict
 from src.FaceBoxesPyTorch.data import cfg
-from src.FaceBoxesPyTorch.layers.functions.prior_box import PriorBox
-from src.FaceBoxesPyTorch.utils.nms_wrapper import nms
+from src.FaceBoxesPyTorch.utils.box_np import get_priors_np, decode_np
+from src.FaceBoxesPyTorch.utils.nms_wrapper import nms, set_backend
 import cv2
-from src.FaceBoxesPyTorch.models.faceboxes import FaceBoxes
-from src.FaceBoxesPyTorch.utils.box_utils import decode
+from src.FaceBoxesPyTorch.utils.weight_paths import fused_weight_path, quantized_weight_path
 from src.FaceBoxesPyTorch.utils.timer import Timer
+from src.detect_engine import create_engine, resolve_precision, torch_dtype, PrecisionEngine
+# torch/网络定义/模型转换/调优模块在需要torch网络时才导入,opencv引擎的推理路径只用numpy和cv2
+
+
+# 单个人脸的检测记录: 包围框(x1, y1, x2, y2), 分数, 关键点(追踪用的中心点), 轨迹id(未跟踪时为-1)
+DET_DTYPE = np.dtype([('box', np.float32, (4,)), ('score', np.float32), ('keyp', np.float32, (2,)),
+                      ('id', np.int64)])
+
+
+class DetectResult(object):
+    """
+    推理结果,不包含任何图像数据
+    dets: 所有人脸的记录数组(DET_DTYPE),按分数降序
+    target: 被选为追踪目标的人脸在dets中的下标,-1表示没有目标
+    """
+    __slots__ = ('dets', 'target')
+
+    def __init__(self, dets, target=-1):
+        self.dets = dets
+        self.target = target
+
+    @classmethod
+    def fromDets(cls, dets):
+        """
+        由[num, 5]的检测框构建结果,目标为面积最大的人脸
+        """
+        rec = np.empty(len(dets), dtype=DET_DTYPE)
+        rec['box'] = dets[:, :4]
+        rec['score'] = dets[:, 4]
+        rec['keyp'][:, 0] = (dets[:, 0] + dets[:, 2]) / 2
+        rec['keyp'][:, 1] = (dets[:, 1] + dets[:, 3]) / 2
+        rec['id'] = -1
+        if len(rec) == 0:
+            return cls(rec)
+        # keep max area
+        areas = (dets[:, 2] - dets[:, 0]) * (dets[:, 3] - dets[:, 1])
+        return cls(rec, int(np.argmax(areas)))
+
+    def hasTarget(self):
+        return self.target >= 0
+
+    def shift(self, dx, dy):
+        """
+        平移所有坐标(原地修改),用于把裁剪区域上的结果映射回整幅图像
+        :return: self
+        """
+        self.dets['box'] += np.array([dx, dy, dx, dy], dtype=np.float32)
+        self.dets['keyp'] += np.array([dx, dy], dtype=np.float32)
+        return self
+
+    @property
+    def box(self):
+        return self.dets['box'][self.target] if self.hasTarget() else None
+
+    @property
+    def score(self):
+        return float(self.dets['score'][self.target]) if self.hasTarget() else None
+
+    @property
+    def id(self):
+        return int(self.dets['id'][self.target]) if self.hasTarget() else -1
+
+    @property
+    def keyp(self):
+        return self.dets['keyp'][self.target].tolist() if self.hasTarget() else None
+
+
+def _to_numpy(x):
+    """
+    引擎输出可能是torch张量或numpy数组(cv2.dnn),统一为numpy,cpu上不拷贝
+    """
+    return x if isinstance(x, np.ndarray) else x.cpu().numpy()
+
+
+def parse_infer_size(value):
+    """
+    解析推理尺寸配置
+    :param value: None/"full" 原图尺寸; "640x360"或(640, 360) 固定宽高; "0.5"或0.5 缩放比例; "640"或640 最长边
+    :return: None, (w, h), float 或 int
+    """
+    if value is None:
+        return None
+    if isinstance(value, (tuple, list)):
+        return int(value[0]), int(value[1])
+    if isinstance(value, (int, float)):
+        return value
+    value = str(value).strip().lower()
+    if value in ("", "full", "none"):
+        return None
+    if "x" in value:
+        w, h = value.split("x")
+        return int(w), int(h)
+    if "." in value:
+        return float(value)
+    return int(value)
 
 
 class FaceDetector(object):
-    def __init__(self, weight_path):
+    # 网络训练时使用的BGR均值
+    _MEAN_BGR = (104, 117, 123)
+    # 输入缓冲区最多保留的尺寸种类
+    _BUFFER_CACHE_SIZE = 4
+
+    def __init__(self, weight_path, nms_backend="auto", infer_size=None, fused=False, engine="eager",
+                 quantized=False, precision="fp32", autotune=False, max_threads=None, activity=None):
         self._confidence_threshold = 0.05
         self._top_k = 50
         self._nms_threshold = 0.3
         self._keep_top_k = 100
 
+        self._device = "cpu"
+        # opencv引擎的输入缓冲区为numpy数组,torch只在导出新尺寸的ONNX或回退到eager时才导入
+        self._use_torch = engine != "opencv"
+        self._net_lock = threading.Lock()
+        # opencv引擎不支持INT8模型,两条路径都解析为float权重
+        quantized = quantized and engine != "opencv"
+        resolved = self._resolveWeights(weight_path, fused, quantized) if engine == "opencv" else None
+        if resolved is not None:
+            # opencv引擎只在导出新尺寸的ONNX(或回退到eager)时才需要torch网络,启动时不加载
+            loaded_path, tag = resolved
+            self._net = None
+            print('Torch model {} will be loaded on demand'.format(loaded_path))
+        else:
+            net, loaded_path, tag = self._loadNet(weight_path, fused, quantized)
+            print('Finished loading model!')
+            print(net)
+            self._net = net.to(self._device)
+        # 执行引擎,编译产物以实际加载的权重文件为缓存键
+        self._engine_args = (engine, loaded_path, tag)
+        # 各 (精度, 内存格式) 的执行引擎,切换精度或调优完成时创建,推理线程只读取
+        self._engines = {}
+        # 创建/替换引擎的锁,精度在界面线程切换,调优在后台线程进行
+        self._engine_lock = threading.RLock()
+        # 单个检测器最多使用的线程数,多进程推理时各进程分摊CPU
+        self._max_threads = max_threads
+        self._default_threads = None
+        if self._use_torch:
+            import torch
+            if max_threads:
+                torch.set_num_threads(max_threads)
+            self._default_threads = torch.get_num_threads()
+        elif max_threads:
+            cv2.setNumThreads(max_threads)
+        # CPU运行参数(线程数/内存格式)自动调优,由setTuneShapes指定的尺寸在后台线程中调优
+        # 结果按 (精度, (h, w)) 保存,推理时按输入尺寸选择,没有结果的尺寸使用默认配置
+        self._tuner = None
+        if autotune and self._use_torch:
+            from src.cpu_tuner import CpuTuner
+            self._tuner = CpuTuner()
+        self._tune_shapes = []
+        self._tune_thread = None
+        # 推理计数,调优据此判断计时期间是否有推理在运行;多进程推理时为各进程共享的multiprocessing.Value
+        self._activity = activity
+        self._infer_count = 0
+        self._shape_configs = {}
+        self._precision = None
+        self.setPrecision(precision)
+        print('Inference engine: {}'.format(self._engine.name))
+        self._t = {'forward_pass': Timer(), 'misc': Timer()}
+        # 选择nms后端,auto为启动时自测最快的实现
+        print('NMS backend: {}'.format(set_backend(nms_backend)))
+        self._infer_size = parse_infer_size(infer_size)
+
+        # 预处理: 输入默认为opencv的bgr图像,不镜像
+        self._input_rgb = False
+        self._input_mirror = False
+        # 融合模型已将均值折叠进conv1,此时input_mean为0
+        self._mean = np.array((0, 0, 0) if tag == "fused" else self._MEAN_BGR, dtype=np.float32).reshape(3, 1, 1)
+        # 按形状复用的网络输入缓冲区和缩放缓冲区,避免每帧分配整帧大小的内存
+        self._input_buffers = OrderedDict()
+        self._resize_buffers = OrderedDict()
+
+    def _resolveWeights(self, weight_path, fused, quantized):
+        """
+        确定要加载的权重文件,不加载网络
+        :param weight_path: 原始权重
+        :param fused: 是否使用折叠了BN和均值的部署模型
+        :param quantized: 是否使用INT8量化模型,优先于fused
+        :return: (权重文件, 模型变体标记),融合模型需要先转换时为None
+        """
+        if quantized:
+            int8_path = quantized_weight_path(weight_path)
+            if os.path.exists(int8_path):
+                return int8_path, "int8"
+            print('INT8 model {} not found, run src/FaceBoxesPyTorch/utils/quantize.py first, '
+                  'fallback to float model'.format(int8_path))
+        if not fused:
+            return weight_path, ""
+        fused_path = fused_weight_path(weight_path)
+        if os.path.exists(fused_path) and os.path.getmtime(fused_path) >= os.path.getmtime(weight_path):
+            return fused_path, "fused"
+        return None
+
+    def _loadWeights(self, path, tag):
+        """
+        按模型变体加载权重文件
+        """
+        import torch
         torch.set_grad_enabled(False)
+        if tag == "int8":
+            from src.FaceBoxesPyTorch.utils.quantize import load_quantized
+            print('Loading INT8 model from {}'.format(path))
+            return load_quantized(path)
+        if tag == "fused":
+            # 直接加载已经折叠好BN和均值的部署模型
+            print('Loading fused model from {}'.format(path))
+            from src.FaceBoxesPyTorch.utils.fuse_model import load_fused
+            return load_fused(path)
+        from src.FaceBoxesPyTorch.models.faceboxes import FaceBoxes
         net = FaceBoxes(phase='test', size=None, num_classes=2)  # initialize detector
-        net = self._load_model(net, weight_path)
+        net = self._load_model(net, path)
         net.eval()
-        print('Finished loading model!')
-        print(net)
-        cudnn.benchmark = True
-        self._device = torch.device("cpu")
-        self._net = net.to(self._device)
-        self._t = {'forward_pass': Timer(), 'misc': Timer()}
+        return net
+
+    def _loadNet(self, weight_path, fused, quantized):
+        """
+        加载网络
+        :param weight_path: 原始权重
+        :param fused: 是否使用折叠了BN和均值的部署模型
+        :param quantized: 是否使用INT8量化模型,优先于fused
+        :return: (网络, 实际加载的权重文件, 模型变体标记)
+        """
+        resolved = self._resolveWeights(weight_path, fused, quantized)
+        if resolved is not None:
+            return (self._loadWeights(*resolved),) + resolved
+
+        # 首次使用时转换,校验与原模型数值一致后保存到原权重旁边
+        from src.FaceBoxesPyTorch.utils.fuse_model import convert_faceboxes, save_fused
+        fused_path = fused_weight_path(weight_path)
+        net = convert_faceboxes(self._loadWeights(weight_path, ""))
+        save_fused(net, fused_path)
+        print('Saved fused model to {}'.format(fused_path))
+        return net, fused_path, "fused"
+
+    def getNet(self):
+        """
+        获取加载好的torch网络(eval模式),opencv引擎启动时不加载,第一次需要时才加载
+        """
+        with self._net_lock:
+            if self._net is None:
+                _, path, tag = self._engine_args
+                self._net = self._loadWeights(path, tag).to(self._device)
+                print('Finished loading model!')
+            return self._net
+
+    def getEngineName(self):
+        return self._engine.name
+
+    def getPrecision(self):
+        return self._precision
+
+    def setPrecision(self, precision, retune=True):
+        """
+        切换前向推理的精度,可在运行时调用,后处理始终为float32
+        :param precision: auto/fp32/bf16/fp16, CPU不支持时回退到fp32
+        :param retune: 是否在后台调优新精度,多进程推理时由主进程安排各进程依次调优
+        :return: 实际使用的精度
+        """
+        engine_name, weight_path, tag = self._engine_args
+        precision = resolve_precision(precision)
+        if precision != "fp32" and (tag == "int8" or engine_name == "opencv"):
+            print('{} model does not support {}, fallback to fp32'.format(tag or engine_name, precision))
+            precision = "fp32"
+        with self._engine_lock:
+            # 拷贝/折叠网络较慢,在调用者的线程中进行,推理线程继续使用旧引擎
+            engine = self._getEngine(precision, "contiguous")
+            # 该精度已调优的尺寸所需的引擎也一并创建
+            for (p, _), config in list(self._shape_configs.items()):
+                if p == precision and config:
+                    self._getEngine(precision, config["layout"])
+            # 推理线程只读取self._engine,替换引用即完成切换
+            self._engine = engine
+            if precision != self._precision:
+                print('Inference precision: {}'.format(precision))
+            self._precision = precision
+        # 新精度的网络需要重新调优
+        if retune:
+            self._startTuning()
+        return precision
+
+    def _getEngine(self, precision, layout):
+        with self._engine_lock:
+            engine = self._engines.get((precision, layout))
+            if engine is None:
+                engine = self._engines[(precision, layout)] = self._createEngine(precision, layout)
+            return engine
+
+    def _castNet(self, precision):
+        """
+        float32网络的低精度副本
+        """
+        from src.FaceBoxesPyTorch.utils.fuse_model import fuse_faceboxes
+        net = copy.deepcopy(self.getNet())
+        if self._engine_args[2] != "fused":
+            # 先在float32下把BN折叠进卷积再转换精度,低精度的BN误差很大(fp16下分数会整体失真)
+            # 均值减法仍在预处理中完成
+            net = fuse_faceboxes(net, mean=None)
+        return net.to(torch_dtype(precision))
+
+    def _createEngine(self, precision, layout="contiguous"):
+        """
+        按精度和内存格式创建执行引擎,不修改共享的网络
+        """
+        engine_name, weight_path, tag = self._engine_args
+        # 编译缓存需要区分精度和内存格式,默认配置保持原来的缓存键
+        variant = tag
+        if precision != "fp32":
+            variant += precision
+        if layout != "contiguous":
+            variant += layout
+        if precision == "fp32":
+            if engine_name == "opencv":
+                # 传入加载函数,ONNX已缓存时不需要torch网络
+                return create_engine(engine_name, self.getNet, weight_path, tag=variant)
+            from src.cpu_tuner import apply_layout
+            net = self.getNet()
+            if layout == "channels_last":
+                net = apply_layout(copy.deepcopy(net), layout)
+            elif layout == "mkldnn":
+                net = apply_layout(net, layout, float_net=tag == "")
+            return create_engine(engine_name, net, weight_path, tag=variant)
+        net = self._castNet(precision)
+        if layout == "channels_last":
+            from src.cpu_tuner import apply_layout
+            net = apply_layout(net, layout)
+        return PrecisionEngine(create_engine(engine_name, net, weight_path, tag=variant), precision)
 
-    def inference(self, frame, thresh=0.7):
+    def setTuneShapes(self, shapes):
         """
-        推理接口
-        :param frame: 输入的图像数据
+        指定需要调优CPU运行参数的网络输入尺寸,在后台线程中逐个调优(本机已有记录的直接读取)
+        推理线程不做调优,某个尺寸调优完成前使用默认的线程数和内存格式
+        :param shapes: [(w, h)],如相机分辨率对应的推理尺寸和局部检测的各档区域尺寸
+        """
+        if self._tuner is None or self._engine_args[0] == "opencv":
+            return
+        with self._engine_lock:
+            for w, h in shapes:
+                if (int(h), int(w)) not in self._tune_shapes:
+                    self._tune_shapes.append((int(h), int(w)))
+        self._startTuning()
+
+    def _startTuning(self):
+        with self._engine_lock:
+            if self._tune_thread is None and self._tune_shapes:
+                self._tune_thread = threading.Thread(target=self._tuneLoop, daemon=True)
+                self._tune_thread.start()
+
+    def isTuning(self):
+        return self._tune_thread is not None
+
+    def _activityCount(self):
+        return self._activity.value if self._activity is not None else self._infer_count
+
+    def _countInference(self):
+        self._infer_count += 1
+        if self._activity is not None:
+            self._activity.value += 1
+
+    def _tuneLoop(self):
+        """
+        调优线程: 按当前精度调优所有还没有结果的尺寸,精度在调优过程中切换时继续调优新精度
+        """
+        while True:
+            with self._engine_lock:
+                precision = self._precision
+                todo = [s for s in self._tune_shapes if (precision, s) not in self._shape_configs]
+                if not todo:
+                    self._tune_thread = None
+                    return
+            self._tuneShape(precision, todo[0])
+
+    def _tuneShape(self, precision, shape):
+        """
+        在实际使用的精度下调优一个输入尺寸,并提前创建所选内存格式的引擎
+        :param shape: (h, w)
+        """
+        from src.cpu_tuner import LAYOUTS
+        engine_name, _, tag = self._engine_args
+        if precision == "fp32":
+            net, float_net = self.getNet(), tag == ""
+        else:
+            net, float_net = self._castNet(precision), False
+        # oneDNN预打包权重只用于eager执行的float32模型
+        layouts = LAYOUTS if engine_name == "eager" and tag != "int8" and precision == "fp32" else LAYOUTS[:2]
+        variant = "{}|{}".format(tag or "float", engine_name)
+        if precision != "fp32":
+            variant += "|" + precision
+        try:
+            config = self._tuner.get(net, (1, 3) + shape, variant, layouts, float_net, torch_dtype(precision),
+                                     activity=self._activityCount)
+            if config is not None:
+                self._getEngine(precision, config["layout"])
+        except Exception as e:
+            print('CPU runtime tuning for {}x{} failed: {}'.format(shape[1], shape[0], e))
+            config = None
+        if config is not None:
+            print('CPU runtime for {}x{} {}: {} threads, {}'.format(shape[1], shape[0], precision,
+                                                                   config["threads"], config["layout"]))
+        with self._engine_lock:
+            # 失败的尺寸记为空配置,使用默认参数,不再重试
+            self._shape_configs[(precision, shape)] = config or {}
+
+    def _selectRuntime(self, in_height, in_width):
+        """
+        按输入尺寸选择调优结果: 只选择已创建的引擎,调优进行中不改变线程数(避免干扰计时)
+        :return: (执行引擎, 内存格式)
+        """
+        engine, layout = self._engine, "contiguous"
+        if self._tuner is None:
+            return engine, layout
+        precision = self._precision
+        config = self._shape_configs.get((precision, (in_height, in_width)))
+        threads = self._default_threads
+        if config:
+            tuned = self._engines.get((precision, config["layout"]))
+            if tuned is not None:
+                engine, layout = tuned, config["layout"]
+            threads = min(config["threads"], self._max_threads or config["threads"])
+        import torch
+        if self._tune_thread is None and torch.get_num_threads() != threads:
+            torch.set_num_threads(threads)
+        return engine, layout
+
+    def makeInput(self, frame):
+        """
+        按当前推理尺寸和输入格式预处理一帧,返回独立的网络输入张量(用于量化校准等离线流程)
+        :return: [1, 3, h, w]
+        """
+        import torch
+        in_width, in_height = self.getInferShape(frame.shape[1], frame.shape[0])
+        img = torch.empty((1, 3, in_height, in_width), dtype=torch.float32)
+        self._preprocess(frame, img.numpy()[0])
+        return img
+
+    def setInputFormat(self, rgb=False, mirror=False):
+        """
+        设置输入图像格式,颜色顺序和镜像在预处理时顺带完成,不额外拷贝
+        :param rgb: 输入是否为rgb顺序(网络需要bgr)
+        :param mirror: 是否水平镜像输入,检测坐标为镜像后画面的坐标
+        """
+        self._input_rgb = rgb
+        self._input_mirror = mirror
+
+    def getInputFormat(self):
+        """
+        :return: (rgb, mirror)
+        """
+        return self._input_rgb, self._input_mirror
+
+    def getInferShape(self, im_width, im_height):
+        """
+        根据推理尺寸配置计算送入网络的图像宽高
+        :param im_width: 原图宽
+        :param im_height: 原图高
+        :return: (w, h)
+        """
+        size = self._infer_size
+        if size is None:
+            return im_width, im_height
+        if isinstance(size, tuple):
+            return size
+        if isinstance(size, float):
+            r = size
+        else:
+            r = min(1.0, size / max(im_width, im_height))
+        return max(32, int(round(im_width * r))), max(32, int(round(im_height * r)))
+
+    def inference(self, frame, thresh=0.7, infer_shape=None):
+        """
+        推理接口,只做检测,不拷贝也不绘制图像
+        :param frame: 输入的图像数据,可以是整幅图像上的裁剪视图
         :param thresh: 分数阈值
-        :return:
+        :param infer_shape: 指定送入网络的宽高(w, h),忽略推理尺寸配置(用于局部区域检测)
+        :return: DetectResult
         """
         assert isinstance(frame, np.ndarray)
-        img_raw = frame.copy()
-        img = np.float32(img_raw)
-        im_height, im_width, _ = img.shape
-        scale = torch.Tensor([img.shape[1], img.shape[0], img.shape[1], img.shape[0]])
-        img -= (104, 117, 123)
-        img = img.transpose(2, 0, 1)
-        img = torch.from_numpy(img).unsqueeze(0)
-        img = img.to(self._device)
-        scale = scale.to(self._device)
+        im_height, im_width, _ = frame.shape
+        # 网络输出的是归一化坐标,直接乘原图宽高即可映射回原图,与推理尺寸无关
+        scale = np.array([im_width, im_height, im_width, im_height], dtype=np.float32)
+        if infer_shape is not None:
+            in_width, in_height = infer_shape
+        else:
+            in_width, in_height = self.getInferShape(im_width, im_height)
+        self._countInference()
+        engine, layout = self._selectRuntime(in_height, in_width)
+        img = self._getInputBuffer(self._input_buffers, (1, 3, in_height, in_width),
+                                   channels_last=layout == "channels_last")
+        self._preprocess(frame, _to_numpy(img)[0])
 
         self._t['forward_pass'].tic()
-        loc, conf = self._net(img)  # forward pass
+        loc, conf = engine(img)  # forward pass
         self._t['forward_pass'].toc()
         self._t['misc'].tic()
 
-        priorbox = PriorBox(cfg, image_size=(im_height, im_width))
-        priors = priorbox.forward()
-        priors = priors.to(self._device)
-        prior_data = priors.data
-        boxes = decode(loc.data.squeeze(0), prior_data, cfg['variance'])
-        boxes = boxes * scale
-        boxes = boxes.cpu().numpy()
-        scores = conf.squeeze(0).data.cpu().numpy()[:, 1]
-
-        # ignore low scores
-        inds = np.where(scores > self._confidence_threshold)[0]
-        boxes = boxes[inds]
-        scores = scores[inds]
-
-        # keep top-K before NMS
-        order = scores.argsort()[::-1][:self._top_k]
-        boxes = boxes[order]
-        scores = scores[order]
-
-        # do NMS
-        dets = np.hstack((boxes, scores[:, np.newaxis])).astype(np.float32, copy=False)
-        keep = nms(dets, self._nms_threshold, force_cpu=True)
-        dets = dets[keep, :]
-
-        # keep top-K faster NMS
-        dets = dets[:self._keep_top_k, :]
+        # priors只与输入尺寸有关,按尺寸缓存,避免每帧重新生成
+        priors = get_priors_np(cfg, (in_height, in_width))
+        dets = self._postprocess(_to_numpy(loc), _to_numpy(conf), priors, scale, thresh)[0]
+        res = DetectResult.fromDets(dets)
         self._t['misc'].toc()
+        return res
 
-        if len(dets) == 0:
-            return [], [], img_raw
-
-        tmp_res = []
-        for b in dets:
-            if b[4] < thresh:
-                continue
-            tmp_res.append(b[:5])
+    def inference_batch(self, frames, thresh=0.7):
+        """
+        批量推理接口,多帧同尺寸图像合并为一次前向
+        :param frames: 同尺寸图像列表
+        :param thresh: 分数阈值
+        :return: 每帧一个DetectResult
+        """
+        if len(frames) == 0:
+            return []
+        im_height, im_width, _ = frames[0].shape
+        assert all(f.shape == frames[0].shape for f in frames), 'inference_batch requires same-sized frames'
+        scale = np.array([im_width, im_height, im_width, im_height], dtype=np.float32)
+        in_width, in_height = self.getInferShape(im_width, im_height)
+        self._countInference()
+        engine, layout = self._selectRuntime(in_height, in_width)
+        img = self._getInputBuffer(self._input_buffers, (len(frames), 3, in_height, in_width),
+                                   channels_last=layout == "channels_last")
+        batch = _to_numpy(img)
+        for i, f in enumerate(frames):
+            self._preprocess(f, batch[i])
 
-        if len(tmp_res) == 0:
-            return [], [], img_raw
+        self._t['forward_pass'].tic()
+        loc, conf = engine(img)  # forward pass
+        self._t['forward_pass'].toc()
+        self._t['misc'].tic()
+        priors = get_priors_np(cfg, (in_height, in_width))
+        dets = self._postprocess(_to_numpy(loc), _to_numpy(conf), priors, scale, thresh)
+        res = [DetectResult.fromDets(d) for d in dets]
+        self._t['misc'].toc()
+        return res
 
-        # keep max area
-        areas = [(_box[2] - _box[0]) * (_box[3] - _box[1]) for _box in tmp_res]
+    def _getInputBuffer(self, buffers, shape, dtype=None, channels_last=False):
+        """
+        按形状取复用的缓冲区,最近最少使用的形状会被释放
+        :param buffers: 缓冲区字典
+        :param shape: 缓冲区形状
+        :param dtype: None为float32的网络输入(torch张量,opencv引擎为numpy数组),否则为该类型的numpy数组
+        :param channels_last: 网络输入是否使用channels_last内存格式(与所选引擎一致)
+        """
+        key = (shape, channels_last)
+        buf = buffers.get(key)
+        if buf is None:
+            if dtype is not None:
+                buf = np.empty(shape, dtype=dtype)
+            elif not self._use_torch:
+                buf = np.empty(shape, dtype=np.float32)
+            elif channels_last:
+                import torch
+                # NHWC存储,预处理直接按原图的HWC顺序写入
+                buf = torch.empty(shape, dtype=torch.float32).contiguous(memory_format=torch.channels_last)
+            else:
+                import torch
+                buf = torch.empty(shape, dtype=torch.float32)
+            buffers[key] = buf
+            while len(buffers) > self._BUFFER_CACHE_SIZE:
+                buffers.popitem(last=False)
+        else:
+            buffers.move_to_end(key)
+        return buf
 
-        # 找到最大面积的包围框
-        max_area_index = np.argmax(areas)
-        max_area_box = tmp_res[max_area_index]
+    def _preprocess(self, frame, out):
+        """
+        融合的预处理: 缩放(可选) -> 镜像/颜色顺序/HWC转CHW(均为视图,不拷贝) -> 减均值,
+        最后一步直接写入预分配的网络输入缓冲区
+        :param frame: HWC的uint8图像
+        :param out: [3, in_height, in_width] 的float32输出缓冲区
+        """
+        in_height, in_width = out.shape[1:]
+        if (in_width, in_height) != (frame.shape[1], frame.shape[0]):
+            resized = self._getInputBuffer(self._resize_buffers, (in_height, in_width, 3), np.uint8)
+            frame = cv2.resize(frame, (in_width, in_height), dst=resized, interpolation=cv2.INTER_LINEAR)
+        img = frame.transpose(2, 0, 1)
+        if self._input_rgb:
+            img = img[::-1]
+        if self._input_mirror:
+            img = img[:, :, ::-1]
+        np.subtract(img, self._mean, out=out, dtype=np.float32)
+        return out
 
-        # 计算中心点
-        # keyp = [(max_area_box[0] + max_area_box[2]) / 2,
-        #         (max_area_box[1] + max_area_box[3]) * 3 / 7]
-        keyp = [(max_area_box[0] + max_area_box[2]) / 2,
-                (max_area_box[1] + max_area_box[3]) / 2]
+    def _postprocess(self, loc, conf, priors, scale, thresh):
+        """
+        后处理: 先按分数剔除,只对剩下的prior解码/缩放,再逐图做nms
+        整个batch的剔除和解码是一次向量化完成的,所有图共用同一组priors
+        :param loc: 位置预测 [batch, num_priors, 4]
+        :param conf: 分类置信度 [batch, num_priors, 2]
+        :param priors: 对应输入尺寸的priors [num_priors, 4]
+        :param scale: 归一化坐标到像素坐标的缩放 [w, h, w, h]
+        :param thresh: 分数阈值
+        :return: 每张图一个nms后按分数降序排列的检测框 [num, 5] (x1, y1, x2, y2, score)
+        """
+        scores = conf[:, :, 1]
+        # 低于thresh的框在nms后同样会被丢弃,直接按两个阈值中较严的一个剔除
+        if thresh > self._confidence_threshold:
+            b_idx, p_idx = np.nonzero(scores >= thresh)
+        else:
+            b_idx, p_idx = np.nonzero(scores > self._confidence_threshold)
+        counts = np.bincount(b_idx, minlength=scores.shape[0])
 
-        # 绘图
-        text = "{:.4f}".format(max_area_box[4])
-        b = list(map(int, max_area_box))
-        cv2.rectangle(img_raw, (b[0], b[1]), (b[2], b[3]), (150, 255, 150), 2)
-        cx = b[0]
-        cy = b[1] + 12
-        cv2.putText(img_raw, text, (cx, cy),
-                    cv2.FONT_HERSHEY_DUPLEX, 0.5, (255, 255, 255))
+        # keep top-K before NMS, 用部分选择代替全排序
+        if counts.max() > self._top_k:
+            sel = []
+            start = 0
+            for c in counts:
+                seg = np.arange(start, start + c)
+                if c > self._top_k:
+                    seg = seg[np.argpartition(scores[b_idx[seg], p_idx[seg]], -self._top_k)[-self._top_k:]]
+                sel.append(seg)
+                start += c
+            sel = np.concatenate(sel)
+            b_idx, p_idx = b_idx[sel], p_idx[sel]
+            counts = np.minimum(counts, self._top_k)
 
-        p = 20
-        cv2.line(img_raw, (int(keyp[0] - p), int(keyp[1])), (int(keyp[0] + p), int(keyp[1])), (0, 70, 100), 2)
-        cv2.line(img_raw, (int(keyp[0]), int(keyp[1] - p)), (int(keyp[0]), int(keyp[1] + p)), (0, 70, 100), 2)
+        dets = np.empty((b_idx.size, 5), dtype=np.float32)
+        dets[:, :4] = decode_np(loc[b_idx, p_idx], priors[p_idx], cfg['variance'])
+        dets[:, :4] *= scale
+        dets[:, 4] = scores[b_idx, p_idx]
 
-        return max_area_box[:4], keyp, img_raw
+        # do NMS, keep top-K faster NMS
+        res = []
+        for d in np.split(dets, np.cumsum(counts)[:-1]):
+            keep = nms(d, self._nms_threshold)
+            res.append(d[keep][:self._keep_top_k])
+        return res
 
     def _load_model(self, model, pretrained_path):
+        import torch
         print('Loading pretrained model from {}'.format(pretrained_path))
         pretrained_dict = torch.load(pretrained_path, map_location=lambda storage, loc: storage)
         if "state_dict" in pretrained_dict.keys():
@@ -152,12 +668,14 @@ class FaceDetector(object):
 
 
 if __name__ == '__main__':
+    from src.detect_overlay import draw_result
+
     face_man = FaceDetector("../weights/FaceBoxes.pth")
     img_path = "../test/5007442.jpg"
     img = cv2.imread(img_path)
     res = face_man.inference(img)
-    print(res[0])
-    print(res[1])
-    cv2.imshow('res', res[2])
+    print(res.box)
+    print(res.keyp)
+    cv2.imshow('res', draw_result(img.copy(), res))
     cv2.waitKey(0)
     pass
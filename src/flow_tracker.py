@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import cv2
+import numpy as np
+from src.face_detect_interface import DetectResult
+
+"""
+帧间跟踪: 两次检测之间用稀疏光流(金字塔LK)传递目标框,检测器只每隔若干帧运行一次
+    * 光流在缩小后的灰度图上计算,前后向一致性检查剔除错误的特征点
+    * 跟踪置信度(存活特征点比例)不足或特征点太少时立即检测
+    * 检测间隔随测得的目标运动自适应: 运动越快,间隔越短
+    * 未检测的帧只更新目标,其余人脸沿用上次检测的记录,画面上的人脸不会在两次检测之间消失
+"""
+
+
+class FlowTracker(object):
+
+    def __init__(self, detector, enabled=True, min_interval=2, max_interval=10, scale=0.5,
+                 drift_budget=0.3, min_points=8, min_confidence=0.5):
+        """
+        :param detector: FaceDetector或RoiDetector
+        :param enabled: 是否启用帧间跟踪,关闭时每帧都检测
+        :param min_interval: 运动很快时的检测间隔(帧)
+        :param max_interval: 几乎静止时的检测间隔(帧)
+        :param scale: 光流计算的图像缩放比例
+        :param drift_budget: 两次检测之间允许目标移动的距离(相对目标框大小),决定自适应间隔
+        :param min_points: 跟踪所需的最少特征点数
+        :param min_confidence: 跟踪置信度下限
+        """
+        self._detector = detector
+        self._enabled = enabled
+        self._min_interval = max(1, min_interval)
+        self._max_interval = max(self._min_interval, max_interval)
+        self._scale = scale
+        self._drift_budget = drift_budget
+        self._min_points = min_points
+        self._min_confidence = min_confidence
+        self._lk_params = dict(winSize=(15, 15), maxLevel=2,
+                               criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.reset()
+
+    def __getattr__(self, name):
+        return getattr(self._detector, name)
+
+    def reset(self):
+        self._prev_gray = None
+        self._points = None
+        self._box = None
+        # 上次检测的全部人脸记录和目标下标
+        self._dets = None
+        self._target = -1
+        self._score = 0.
+        self._confidence = 1.
+        self._id = -1
+        self._since_detect = 0
+        self._interval = self._min_interval
+        # 目标每帧的移动距离(相对目标框大小)的平滑值
+        self._motion = 0.
+        if hasattr(self._detector, "reset"):
+            self._detector.reset()
+
+    def getInterval(self):
+        return self._interval
+
+    def _gray(self, frame):
+        small = cv2.resize(frame, None, fx=self._scale, fy=self._scale, interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        if self.getInputFormat()[1]:
+            # 检测结果是镜像后画面的坐标,光流也在镜像后的画面上计算
+            gray = cv2.flip(gray, 1)
+        return gray
+
+    def _initPoints(self, gray, box):
+        """
+        在目标框(缩小后坐标)内选取特征点
+        """
+        x1, y1, x2, y2 = [int(round(v)) for v in box]
+        mask = np.zeros_like(gray)
+        mask[max(y1, 0):max(y2, 0), max(x1, 0):max(x2, 0)] = 255
+        return cv2.goodFeaturesToTrack(gray, maxCorners=50, qualityLevel=0.01, minDistance=3, mask=mask)
+
+    def _track(self, gray):
+        """
+        用前后向光流传递目标框
+        :return: 是否跟踪成功
+        """
+        if self._points is None or len(self._points) < self._min_points:
+            return False
+        p1, st1, _ = cv2.calcOpticalFlowPyrLK(self._prev_gray, gray, self._points, None, **self._lk_params)
+        p0, st0, _ = cv2.calcOpticalFlowPyrLK(gray, self._prev_gray, p1, None, **self._lk_params)
+        fb_err = np.linalg.norm((p0 - self._points).reshape(-1, 2), axis=1)
+        good = (st1.ravel() == 1) & (st0.ravel() == 1) & (fb_err < 1.0)
+        confidence = good.mean()
+        if good.sum() < self._min_points or confidence < self._min_confidence:
+            return False
+
+        old = self._points.reshape(-1, 2)[good]
+        new = p1.reshape(-1, 2)[good]
+        shift = np.median(new - old, axis=0)
+        # 尺度变化: 特征点两两距离之比的中位数
+        d_old = np.linalg.norm(old[:, None] - old[None], axis=2)
+        d_new = np.linalg.norm(new[:, None] - new[None], axis=2)
+        valid = d_old > 1e-3
+        s = float(np.median(d_new[valid] / d_old[valid])) if valid.any() else 1.
+
+        x1, y1, x2, y2 = self._box
+        cx, cy = (x1 + x2) / 2 + shift[0], (y1 + y2) / 2 + shift[1]
+        hw, hh = (x2 - x1) / 2 * s, (y2 - y1) / 2 * s
+        size = max(x2 - x1, y2 - y1, 1.)
+        self._box = np.array([cx - hw, cy - hh, cx + hw, cy + hh], dtype=np.float32)
+        self._points = new.reshape(-1, 1, 2)
+        self._confidence = confidence
+        self._updateMotion(float(np.hypot(*shift)) / size)
+        return True
+
+    def _updateMotion(self, motion):
+        """
+        根据目标运动更新检测间隔: 两次检测之间目标移动不超过drift_budget
+        """
+        self._motion = 0.7 * self._motion + 0.3 * motion
+        interval = self._drift_budget / max(self._motion, 1e-6)
+        self._interval = int(np.clip(interval, self._min_interval, self._max_interval))
+
+    def _result(self):
+        """
+        上次检测的记录中只替换目标: 目标框为跟踪框,分数为检测分数乘以当前的跟踪置信度
+        """
+        box = self._box / self._scale
+        dets = self._dets.copy()
+        rec = dets[self._target]
+        rec['box'] = box
+        rec['score'] = self._score * self._confidence
+        rec['keyp'] = ((box[0] + box[2]) / 2, (box[1] + box[3]) / 2)
+        rec['id'] = self._id
+        return DetectResult(dets, self._target)
+
+    def inference(self, frame, thresh=0.7):
+        """
+        与FaceDetector.inference相同的接口,未检测的帧目标为跟踪框,其余人脸为上次检测的记录
+        :return: DetectResult
+        """
+        if not self._enabled:
+            return self._detector.inference(frame, thresh)
+
+        gray = self._gray(frame)
+        if self._box is not None and self._since_detect < self._interval and self._track(gray):
+            self._prev_gray = gray
+            self._since_detect += 1
+            return self._result()
+
+        res = self._detector.inference(frame, thresh)
+        if res.hasTarget():
+            box = res.box * self._scale
+            if self._box is not None and self._since_detect > 0:
+                # 用检测结果校正跟踪框,校正量同样计入运动估计
+                size = max(box[2] - box[0], box[3] - box[1], 1.)
+                centers = (box[:2] + box[2:]) / 2 - (self._box[:2] + self._box[2:]) / 2
+                self._updateMotion(float(np.hypot(*centers)) / size / self._since_detect)
+            self._box = box
+            self._dets = res.dets.copy()
+            self._target = res.target
+            self._score = res.score
+            self._confidence = 1.
+            self._id = res.id
+            self._points = self._initPoints(gray, box)
+        else:
+            self._box = None
+            self._dets = None
+            self._points = None
+            self._interval = self._min_interval
+        self._prev_gray = gray
+        self._since_detect = 0
+        return res
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import threading
+
+"""
+帧交换: 生产者(采集线程)把填好的帧换到前台,消费者阻塞等待比自己上次处理的更新的帧
+    * 每帧带单调递增的序号和采集时间,消费者据此跳过已处理的帧,并能知道中间丢了几帧
+    * 双缓冲: 生产者在后台缓冲区(帧缓冲池)中填充下一帧,publish时与前台交换,旧的前台帧被释放
+    * 基于条件变量等待,不需要轮询
+"""
+
+
+class FramePacket(object):
+    """
+    交换出来的一帧,持有帧缓冲区的一个引用,用完需要release(或使用with)
+    """
+    __slots__ = ('seq', 'time', '_handle')
+
+    def __init__(self, seq, time, handle):
+        self.seq = seq
+        self.time = time
+        self._handle = handle
+
+    @property
+    def frame(self):
+        """
+        只读的图像视图
+        """
+        return self._handle.frame
+
+    def release(self):
+        if self._handle is not None:
+            self._handle.release()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class FrameExchange(object):
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._time = 0.
+        self._front = None
+        self._closed = False
+
+    def publish(self, handle, t):
+        """
+        把填好的帧换到前台,交换持有该句柄的引用
+        :param handle: FrameHandle
+        :param t: 采集时间
+        :return: 该帧的序号
+        """
+        with self._cond:
+            old = self._front
+            self._seq += 1
+            self._time = t
+            self._front = handle
+            self._closed = False
+            seq = self._seq
+            self._cond.notify_all()
+        if old is not None:
+            old.release()
+        return seq
+
+    def getSeq(self):
+        """
+        最新一帧的序号,还没有帧时为0
+        """
+        return self._seq
+
+    def latest(self):
+        """
+        :return: 当前前台帧的FramePacket,没有帧时为None
+        """
+        with self._cond:
+            return self._packet()
+
+    def waitForFrame(self, after_seq=0, timeout=None):
+        """
+        等待序号大于after_seq的帧
+        :param after_seq: 上一次处理的帧序号
+        :param timeout: 超时时间(秒),None为一直等待
+        :return: FramePacket,超时或交换关闭时为None
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._closed or (self._front is not None and self._seq > after_seq),
+                                       timeout):
+                return None
+            return self._packet()
+
+    def _packet(self):
+        # 调用时已持有self._cond
+        if self._closed or self._front is None:
+            return None
+        return FramePacket(self._seq, self._time, self._front.acquire())
+
+    def close(self):
+        """
+        释放前台帧并唤醒所有等待者,序号继续累加
+        """
+        with self._cond:
+            old = self._front
+            self._front = None
+            self._closed = True
+            self._cond.notify_all()
+        if old is not None:
+            old.release()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import threading
+import numpy as np
+
+"""
+帧缓冲池: 预分配固定数量的整帧缓冲区循环使用,采集不再每帧分配新的数组
+    * 每个缓冲区通过FrameHandle引用计数,最后一个持有者release后回到池中
+    * 使用者拿到的是只读视图,要长期持有一帧时acquire一次,用完release
+    * 池中的缓冲区都被占用时临时分配一个不回收的缓冲区,采集不会因为下游慢而阻塞
+"""
+
+
+class FrameHandle(object):
+    __slots__ = ('_pool', '_buffer', '_view', '_refs')
+
+    def __init__(self, pool, buffer):
+        self._pool = pool
+        self._buffer = buffer
+        self._view = None
+        self._refs = 1
+
+    @property
+    def buffer(self):
+        """
+        可写的缓冲区,只给生产者(采集线程)填充数据用
+        """
+        return self._buffer
+
+    @property
+    def frame(self):
+        """
+        只读视图
+        """
+        if self._view is None:
+            self._view = self._buffer.view()
+            self._view.flags.writeable = False
+        return self._view
+
+    def acquire(self):
+        """
+        增加一个持有者
+        :return: self
+        """
+        with self._pool._lock:
+            assert self._refs > 0, "frame handle already released"
+            self._refs += 1
+        return self
+
+    def release(self):
+        """
+        减少一个持有者,没有持有者时缓冲区回到池中
+        """
+        with self._pool._lock:
+            assert self._refs > 0, "frame handle already released"
+            self._refs -= 1
+            if self._refs == 0:
+                self._pool._recycle(self._buffer)
+                self._buffer = None
+                self._view = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class FramePool(object):
+
+    def __init__(self, size=8):
+        """
+        :param size: 池中缓冲区的最大个数
+        """
+        self._size = size
+        self._lock = threading.Lock()
+        self._shape = None
+        self._free = []
+        # 属于池的缓冲区(按id),临时分配的缓冲区不在其中
+        self._owned = set()
+        self._misses = 0
+
+    def get(self, shape, dtype=np.uint8):
+        """
+        取一个形状为shape的缓冲区,引用计数为1
+        :return: FrameHandle
+        """
+        shape = tuple(shape)
+        with self._lock:
+            if shape != self._shape:
+                # 分辨率变化,旧尺寸的缓冲区不再回收
+                self._shape = shape
+                self._free = []
+                self._owned = set()
+            if self._free:
+                buffer = self._free.pop()
+            elif len(self._owned) < self._size:
+                buffer = np.empty(shape, dtype=dtype)
+                self._owned.add(id(buffer))
+            else:
+                buffer = np.empty(shape, dtype=dtype)
+                self._misses += 1
+        return FrameHandle(self, buffer)
+
+    def _recycle(self, buffer):
+        # 调用时已持有self._lock
+        if id(buffer) in self._owned:
+            self._free.append(buffer)
+
+    def getMisses(self):
+        """
+        池耗尽后临时分配的次数,持续增长说明有使用者没有release
+        """
+        return self._misses
+
+    def getFreeCount(self):
+        return len(self._free)
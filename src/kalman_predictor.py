@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import collections
+import math
+
+import numpy as np
+
+"""
+关键点的延迟补偿: 匀速模型的卡尔曼滤波,按帧的时间戳更新,
+输出命令实际执行时刻(帧时间 + 采集/推理/串口延迟)目标所在的预测位置
+    * 云台转动会使整个画面平移,滤波在与云台角度无关的固定坐标系中进行(GimbalMotion),
+      否则云台转向目标的运动会被当作目标的速度,预测过冲
+"""
+
+
+class KeypointPredictor(object):
+
+    def __init__(self, process_noise=5000., measure_noise=4., max_dropout=0.5, max_horizon=0.3):
+        """
+        :param process_noise: 加速度噪声的功率谱密度(像素^2/秒^3),越大越信任新的观测
+        :param measure_noise: 关键点观测噪声的标准差(像素)
+        :param max_dropout: 连续丢失检测超过该时长(秒)后放弃目标
+        :param max_horizon: 从最后一次观测算起的最大外推时长(秒),防止延迟异常或丢失检测时外推过远
+        """
+        self._q = process_noise
+        self._r = measure_noise ** 2
+        self._max_dropout = max_dropout
+        self._max_horizon = max_horizon
+        self._H = np.array([[1., 0., 0., 0.], [0., 1., 0., 0.]])
+        self.reset()
+
+    def reset(self):
+        # 状态 [x, y, vx, vy] 及其协方差
+        self._x = None
+        self._P = None
+        self._t = None
+        self._t_measure = None
+
+    def isTracking(self):
+        return self._x is not None
+
+    def _transition(self, dt):
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        # 离散白噪声加速度模型
+        q = self._q
+        Q1 = np.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]]) * q
+        Q = np.zeros((4, 4))
+        Q[np.ix_([0, 2], [0, 2])] = Q1
+        Q[np.ix_([1, 3], [1, 3])] = Q1
+        return F, Q
+
+    def update(self, t, z):
+        """
+        用一帧的检测结果更新滤波器
+        :param t: 帧的采集时间(秒)
+        :param z: 关键点(x, y),该帧没有检测到目标时为None
+        :return: 是否仍在跟踪目标
+        """
+        if self._x is None:
+            if z is not None:
+                self._x = np.array([z[0], z[1], 0., 0.])
+                # 初始速度未知,给一个较大的方差
+                self._P = np.diag([self._r, self._r, 1e6, 1e6])
+                self._t = self._t_measure = t
+            return self._x is not None
+
+        dt = max(t - self._t, 0.)
+        F, Q = self._transition(dt)
+        self._x = F @ self._x
+        self._P = F @ self._P @ F.T + Q
+        self._t = t
+
+        if z is None:
+            # 短暂丢失时按速度继续外推,超时后放弃
+            if t - self._t_measure > self._max_dropout:
+                self.reset()
+                return False
+            return True
+
+        H = self._H
+        y = np.asarray(z, dtype=np.float64) - H @ self._x
+        S = H @ self._P @ H.T + np.eye(2) * self._r
+        K = self._P @ H.T @ np.linalg.inv(S)
+        self._x = self._x + K @ y
+        self._P = (np.eye(4) - K @ H) @ self._P
+        self._t_measure = t
+        return True
+
+    def predict(self, t):
+        """
+        预测t时刻的关键点位置,不改变滤波器状态
+        :return: (x, y),没有目标或丢失检测已超过最大外推时长时为None
+        """
+        if self._x is None:
+            return None
+        # 外推时长从最后一次观测算起,丢失检测期间外推的部分同样计入
+        t_end = self._t_measure + self._max_horizon
+        if self._t > t_end:
+            return None
+        dt = min(max(t, self._t), t_end) - self._t
+        return self._x[0] + self._x[2] * dt, self._x[1] + self._x[3] * dt
+
+
+class GimbalMotion(object):
+    """
+    记录云台命令的生效时刻和角度,在画面坐标和固定坐标系之间换算关键点
+    固定坐标系为云台角度均为0时的画面坐标: 云台角度增大(右转/下转)时画面中的物体向左/上移动
+    """
+
+    def __init__(self, hfov=52., history=32):
+        """
+        :param hfov: 相机水平视场角(度),用于角度与像素的换算,0表示不做补偿
+        :param history: 保留的命令条数,需覆盖采集到命令执行的整个延迟
+        """
+        self._hfov = hfov
+        self._history = collections.deque(maxlen=history)
+
+    def reset(self, h_angle, v_angle):
+        """
+        :param h_angle: 当前水平角(度)
+        :param v_angle: 当前竖直角(度)
+        """
+        self._history.clear()
+        self._history.append((-math.inf, h_angle, v_angle))
+
+    def record(self, t, h_angle, v_angle):
+        """
+        记录一条云台命令
+        :param t: 命令生效时刻(秒,time.perf_counter)
+        """
+        self._history.append((t, h_angle, v_angle))
+
+    def angle(self, t):
+        """
+        t时刻云台的(水平角, 竖直角): 该时刻之前最后生效的命令,早于全部记录时取最早的一条
+        """
+        if not self._history:
+            return 0., 0.
+        _, h, v = self._history[0]
+        for t_cmd, h_cmd, v_cmd in self._history:
+            if t_cmd > t:
+                break
+            h, v = h_cmd, v_cmd
+        return h, v
+
+    def _pixelsPerDegree(self, width):
+        if self._hfov <= 0:
+            return 0.
+        # 光轴附近每度对应的像素数: 焦距(像素) * 每度的弧度
+        return width / 2 / math.tan(math.radians(self._hfov) / 2) * math.pi / 180
+
+    def toFixed(self, t, kp, width):
+        """
+        t时刻采集的画面中的关键点换算到固定坐标系
+        :param width: 画面宽度(像素)
+        """
+        ppd = self._pixelsPerDegree(width)
+        h, v = self.angle(t)
+        return kp[0] + h * ppd, kp[1] + v * ppd
+
+    def toImage(self, t, kp, width):
+        """
+        固定坐标系中的关键点换算到t时刻云台角度下的画面
+        """
+        ppd = self._pixelsPerDegree(width)
+        h, v = self.angle(t)
+        return kp[0] - h * ppd, kp[1] - v * ppd
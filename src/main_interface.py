@@ -4,14 +4,16 @@ import time
 
 from PyQt5.QtGui import QColor, QImage, QPixmap
 from PyQt5.QtWidgets import QWidget, QGraphicsDropShadowEffect, QSizePolicy
-from PyQt5.QtCore import pyqtSignal, QSettings, Qt, QDateTime
+from PyQt5.QtCore import pyqtSignal, QSettings, Qt, QDateTime, QEvent
 from qfluentwidgets import setFont, MessageBox, PlainTextEdit
-import cv2
 from view.ui_main import Ui_Main
 from src.servo_manager import ServoManager
 from src.camera_manager import CameraManager
 from src.trancking_plot1 import trancking_plot1
 from src.trancking_plot2 import trancking_plot2
+from src.detect_overlay import fit_to_view, draw_result, draw_center_lines
+from src.kalman_predictor import KeypointPredictor, GimbalMotion
+from src.pipeline import Pipeline
 
 """
     主程序界面
@@ -37,6 +39,27 @@ class MainInterface(Ui_Main, QWidget):
         self.camera_manager = camera_manager
         self.servo_manager = servo_manager
 
+        # 关键点延迟补偿: 发给云台的是命令执行时刻目标的预测位置
+        self._use_predictor = str(self.settings.value("KalmanPredict", "true")).lower() == "true"
+        self._predictor = KeypointPredictor(max_dropout=float(self.settings.value("KalmanMaxDropout", 0.5)))
+        # 云台自身运动补偿: 按命令记录云台角度,关键点在固定坐标系中滤波,只在控制线程中访问
+        self._gimbal = GimbalMotion(hfov=float(self.settings.value("CamHFov", 52)))
+        # 串口命令往返耗时(平滑值),以及额外的执行延迟(舵机响应等,秒)
+        self._servo_rtt = 0.
+        self._servo_latency = float(self.settings.value("ServoLatencyMs", 0)) / 1000
+
+        # 采集 -> 推理 -> 控制/显示 的分级流水线,采集线程只负责把最新帧放入队列
+        self._pipeline = Pipeline()
+        # 队列中的帧持有帧缓冲池的引用,被覆盖丢弃时释放
+        self._frame_slot = self._pipeline.addSlot(self._releaseItem)
+        self._control_slot = self._pipeline.addSlot(self._releaseItem)
+        self._display_slot = self._pipeline.addSlot(self._releaseItem)
+        self._view_slot = self._pipeline.addSlot()
+        self._pipeline.addStage("infer", self._inferStage, self._frame_slot, [self._control_slot, self._display_slot])
+        self._pipeline.addStage("control", self._controlStage, self._control_slot)
+        self._display_stage = self._pipeline.addStage("display", self._displayStage, self._display_slot,
+                                                      [self._view_slot])
+
         setFont(self.sysButton, 17)
 
         # 设置控件阴影
@@ -47,6 +70,13 @@ class MainInterface(Ui_Main, QWidget):
 
         self.helpPlainTextEdit.setFocusPolicy(Qt.NoFocus)
 
+        # 显示线程只读取这两个缓存值,不访问控件: 显示控件的大小在其Resize事件中更新,叠加层开关在切换时更新
+        self._view_size = (self.frameview.width(), self.frameview.height())
+        self._show_overlay = self.debugviewSwitchButton.isChecked()
+        # 控制线程同样只读取缓存的追踪策略,在单选按钮切换时更新
+        self._use_plot1 = self.plot1RadioButton.isChecked()
+        self.frameview.installEventFilter(self)
+
         self.sysButton.setShortcut("space")
 
         # 设置帮助信息
@@ -72,6 +102,21 @@ class MainInterface(Ui_Main, QWidget):
         self.face_tracking_sign.connect(self.faceTracking, Qt.DirectConnection)
 
         self.clear_view_sign.connect(self.clearViewSlot, Qt.DirectConnection)
+        self.debugviewSwitchButton.checkedChanged.connect(self.debugViewSlot)
+        self.plot1RadioButton.toggled.connect(self.trackingPlotSlot)
+        # 显示线程准备好画面后,由界面线程取最新的一帧显示
+        self._display_stage.output_sign.connect(self.showFrameSlot, Qt.QueuedConnection)
+
+    def eventFilter(self, obj, event):
+        if obj is self.frameview and event.type() == QEvent.Resize:
+            self._view_size = (event.size().width(), event.size().height())
+        return super().eventFilter(obj, event)
+
+    def debugViewSlot(self, checked):
+        self._show_overlay = checked
+
+    def trackingPlotSlot(self, checked):
+        self._use_plot1 = checked
 
     def clearViewSlot(self):
         self.frameview.setPixmap(
@@ -81,16 +126,26 @@ class MainInterface(Ui_Main, QWidget):
         assert isinstance(self.servo_manager, ServoManager)
         if not self.isRunning:
             return
-        if self.plot1RadioButton.isChecked():
+        count = self.servo_manager.getCommandCount()
+        if self._use_plot1:
             trancking_plot1(info, self.servo_manager)
         else:
             trancking_plot2(info, self.servo_manager)
+        # 只在实际发送了命令时更新往返耗时,死区内不发命令的调用耗时接近0,会拉低估计
+        if self.servo_manager.getCommandCount() != count:
+            self._servo_rtt = 0.8 * self._servo_rtt + 0.2 * self.servo_manager.getLastCommandTime()
+            # 命令写完后舵机再经过执行延迟到位
+            self._gimbal.record(time.perf_counter() + self._servo_latency,
+                                self.servo_manager.getHorizontalServoAngle(),
+                                self.servo_manager.getVerticalServoAngle())
 
     def sysBtnClickedSlot(self):
         assert isinstance(self.servo_manager, ServoManager)
         assert isinstance(self.camera_manager, CameraManager)
         if self.isRunning:
             self.isRunning = False
+            # 先停流水线,控制线程不再访问串口
+            self._pipeline.stop()
             self.servo_manager.disconnectSerial()
             self.camera_manager.disconnect()
             time.sleep(0.3)  # todo 可能会有时序错乱问题，等一下
@@ -119,35 +174,94 @@ class MainInterface(Ui_Main, QWidget):
                     return
             self.sys_running_sign.emit(True)
             self.isRunning = True
+            # 重新开始追踪,第一帧做全图检测
+            self.face_detector.reset()
+            self._predictor.reset()
             self.servo_manager.connectSerial(self.settings.value("ServoIdx"))
+            self._gimbal.reset(self.servo_manager.getHorizontalServoAngle(),
+                               self.servo_manager.getVerticalServoAngle())
             self.camera_manager.connect(int(self.settings.value("CamIdx")))
+            self._pipeline.start()
             self.camera_manager.update_frame_sign.connect(self.updateFrameSlot, Qt.DirectConnection)
             self.ElevatedCardWidget.setEnabled(True)
             self.sysButton.setText("暂停系统")
 
     def updateFrameSlot(self, frame):
-        _frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # opencv读取的bgr格式图片转换成rgb格式
-        _raw_frame = _frame.copy()
-        # 推理
-        res, keyp, _frame = self.face_detector.inference(_frame)
-        h = _frame.shape[0]
-        w = _frame.shape[1]
-        cv2.line(_frame, (0, int(h / 2)), (w, int(h / 2)), (255, 0, 0), 1)
-        cv2.line(_frame, (int(w / 2), 0), (int(w / 2), h), (0, 0, 255), 1)
-
-        # 将关键点发出去
-        if keyp:
-            self.face_tracking_sign.emit([*keyp, _frame.shape[1], _frame.shape[0]])
-
-        if self.debugviewSwitchButton.isChecked():
-            _image = QImage(_frame[:], _frame.shape[1], _frame.shape[0], _frame.shape[1] * 3,
-                            QImage.Format_RGB888)
-        else:
-            _image = QImage(_raw_frame[:], _raw_frame.shape[1], _raw_frame.shape[0], _raw_frame.shape[1] * 3,
-                            QImage.Format_RGB888)
-        _out = QPixmap(_image)
+        # 在采集线程中调用,只把最新帧和采集时间放入推理队列,不阻塞采集
+        # 帧在槽函数返回后还要使用,持有其缓冲区直到各级处理完
+        handle = self.camera_manager.getFrameHandle().acquire()
+        self._frame_slot.put((handle, self.camera_manager.getFrameTime()))
+
+    @staticmethod
+    def _releaseItem(item):
+        item[0].release()
+
+    def _inferStage(self, item):
+        """
+        推理线程: 网络和显示都直接使用opencv的bgr图像,不再做颜色转换
+        """
+        handle, t = item
+        try:
+            if hasattr(self.face_detector, "setFrameTime"):
+                # 多人脸跟踪按帧的采集时间做卡尔曼预测
+                self.face_detector.setFrameTime(t)
+            res = self.face_detector.inference(handle.frame)
+        except Exception:
+            handle.release()
+            raise
+        finally:
+            # 推理完成后才向相机要下一帧,grab模式下拿到的是此刻最新的帧
+            self.camera_manager.requestFrame()
+        # 控制和显示各持有一个引用
+        handle.acquire()
+        return handle, t, res
+
+    def _controlStage(self, item):
+        """
+        控制线程: 将关键点发给云台
+        """
+        handle, t, res = item
+        # 只需要图像尺寸,不再持有缓冲区
+        h, w = handle.frame.shape[:2]
+        handle.release()
+        if self._use_predictor:
+            # 按帧的采集时间更新,观测先换算到固定坐标系,扣除采集时刻云台转动造成的画面平移
+            kp = res.keyp
+            self._predictor.update(t, None if kp is None else self._gimbal.toFixed(t, kp, w))
+            # 命令执行时刻 = 当前时刻(已包含采集/推理/排队耗时) + 串口往返 + 额外执行延迟
+            t_cmd = time.perf_counter() + self._servo_rtt + self._servo_latency
+            # 丢失检测超过最大外推时长后不再给出位置,云台停在原地等待重新检测到目标
+            kp = self._predictor.predict(t_cmd)
+            if kp is not None:
+                kp = self._gimbal.toImage(t_cmd, kp, w)
+                self.face_tracking_sign.emit([min(max(kp[0], 0), w - 1), min(max(kp[1], 0), h - 1), w, h])
+        elif res.hasTarget():
+            self.face_tracking_sign.emit([*res.keyp, w, h])
+
+    def _displayStage(self, item):
+        """
+        显示线程: 缩放到显示控件大小并绘制叠加层,界面线程只需要设置图片
+        :return: QImage
+        """
+        handle, t, res = item
+        try:
+            _frame, r = fit_to_view(handle.frame, *self._view_size)
+        finally:
+            handle.release()
+        if self._show_overlay:
+            # 叠加层直接画在显示分辨率的图像上
+            draw_result(_frame, res, r)
+            draw_center_lines(_frame)
+        # QImage不拷贝数据,copy一份使其不依赖numpy数组的生命周期
+        return QImage(_frame.data, _frame.shape[1], _frame.shape[0], _frame.strides[0],
+                      QImage.Format_BGR888).copy()
+
+    def showFrameSlot(self):
+        image = self._view_slot.take()
+        if image is None or not self.isRunning:
+            return
         # 调整图片尺寸以适应label大小，并更新label上的图片显示
-        self.frameview.setPixmap(_out.scaled(self.frameview.size(), aspectRatioMode=True))
+        self.frameview.setPixmap(QPixmap.fromImage(image).scaled(self.frameview.size(), aspectRatioMode=True))
 
     def setShadowEffect(self, card: QWidget):
         shadowEffect = QGraphicsDropShadowEffect(self)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import cv2
+import numpy as np
+
+"""
+运动门控: 画面没有变化时跳过检测,直接复用上一次的结果
+    在缩小的灰度图上与上一次推理时的画面做差,变化像素的比例(运动能量)低于阈值则跳过,
+    每隔refresh_interval帧强制推理一次,防止缓慢变化一直被忽略
+"""
+
+
+class MotionGate(object):
+
+    def __init__(self, detector, enabled=True, pixel_thresh=12, area_thresh=0.002, refresh_interval=30,
+                 size=(80, 45)):
+        """
+        :param detector: 任意检测器(FaceDetector/RoiDetector/FlowTracker...)
+        :param enabled: 是否启用门控
+        :param pixel_thresh: 灰度差超过该值的像素计为变化
+        :param area_thresh: 变化像素比例超过该值才推理
+        :param refresh_interval: 最多连续跳过的帧数
+        :param size: 计算运动能量的图像尺寸(w, h)
+        """
+        self._detector = detector
+        self._enabled = enabled
+        self._pixel_thresh = pixel_thresh
+        self._area_thresh = area_thresh
+        self._refresh_interval = refresh_interval
+        self._size = tuple(size)
+        self.reset()
+
+    def __getattr__(self, name):
+        return getattr(self._detector, name)
+
+    def reset(self):
+        self._ref = None
+        self._res = None
+        self._skipped = 0
+        self._energy = 0.
+        if hasattr(self._detector, "reset"):
+            self._detector.reset()
+
+    def getMotionEnergy(self):
+        """
+        最近一帧的运动能量(变化像素比例)
+        """
+        return self._energy
+
+    def isIdle(self):
+        """
+        上一帧是否跳过了推理
+        """
+        return self._skipped > 0
+
+    def _downsample(self, frame):
+        """
+        缩小并转灰度: 先隔行隔列抽样,再用面积插值缩小到目标尺寸(同时起到去噪的作用),
+        整幅图像上直接做面积插值的开销要大几倍
+        """
+        step = max(1, min(frame.shape[1] // self._size[0], frame.shape[0] // self._size[1]) // 4)
+        small = cv2.resize(frame[::step, ::step], self._size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    def motionEnergy(self, small):
+        """
+        :param small: 缩小后的灰度图
+        :return: 与参考帧相比变化像素的比例
+        """
+        if self._ref is None or self._ref.shape != small.shape:
+            return 1.
+        diff = cv2.absdiff(small, self._ref)
+        return np.count_nonzero(diff > self._pixel_thresh) / diff.size
+
+    def inference(self, frame, thresh=0.7):
+        """
+        与FaceDetector.inference相同的接口,静止画面返回上一次的结果
+        """
+        if not self._enabled:
+            return self._detector.inference(frame, thresh)
+        small = self._downsample(frame)
+        self._energy = self.motionEnergy(small)
+        if self._res is not None and self._energy < self._area_thresh and self._skipped < self._refresh_interval:
+            self._skipped += 1
+            return self._res
+
+        self._res = self._detector.inference(frame, thresh)
+        # 参考帧为最近一次推理时的画面,缓慢的累积变化最终也会触发推理
+        self._ref = small
+        self._skipped = 0
+        return self._res
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from PyQt5.QtCore import QThread, pyqtSignal
+
+"""
+分级流水线: 采集 -> 推理 -> 控制/显示,每一级在自己的线程中运行
+    * 相邻两级之间是单槽队列,新数据覆盖还没被取走的旧数据,每一级总是处理最新的数据
+    * 慢的一级只会丢帧,不会阻塞上游,端到端延迟由最慢的一级决定,而不是各级耗时之和
+"""
+
+
+class LatestSlot(object):
+    """
+    单槽队列: put覆盖未取走的数据,get阻塞直到有新数据
+    """
+
+    def __init__(self, on_drop=None):
+        """
+        :param on_drop: 数据被覆盖或随队列关闭被丢弃时的回调(释放数据持有的资源)
+        """
+        self._on_drop = on_drop
+        self._cond = threading.Condition()
+        self._item = None
+        self._has_item = False
+        self._closed = False
+        self._dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if self._closed:
+                self._drop(item)
+                return
+            if self._has_item:
+                self._dropped += 1
+                self._drop(self._item)
+            self._item = item
+            self._has_item = True
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        :return: 最新的数据,队列关闭或超时时为None
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._has_item or self._closed, timeout):
+                return None
+            return self._pop()
+
+    def take(self):
+        """
+        非阻塞地取走数据,没有新数据时为None
+        """
+        with self._cond:
+            return self._pop()
+
+    def _pop(self):
+        if not self._has_item:
+            return None
+        item = self._item
+        self._item = None
+        self._has_item = False
+        return item
+
+    def open(self):
+        with self._cond:
+            self._item = None
+            self._has_item = False
+            self._closed = False
+            self._dropped = 0
+
+    def close(self):
+        """
+        关闭队列并唤醒等待的线程
+        """
+        with self._cond:
+            self._closed = True
+            if self._has_item:
+                self._drop(self._item)
+            self._item = None
+            self._has_item = False
+            self._cond.notify_all()
+
+    def _drop(self, item):
+        if self._on_drop is not None:
+            self._on_drop(item)
+
+    def getDropped(self):
+        """
+        被覆盖(丢弃)的数据个数
+        """
+        return self._dropped
+
+
+class StageWorker(QThread):
+    """
+    流水线的一级: 从输入槽取最新的数据,处理后放入所有输出槽
+    """
+    output_sign = pyqtSignal()
+
+    def __init__(self, name, func, in_slot, out_slots=()):
+        """
+        :param name: 名称,用于打印异常
+        :param func: 处理函数 func(item) -> 输出,返回None时不输出
+        :param in_slot: 输入的LatestSlot
+        :param out_slots: 输出的LatestSlot列表
+        """
+        super().__init__()
+        self._name = name
+        self._func = func
+        self._in = in_slot
+        self._outs = list(out_slots)
+        # 单次处理耗时的平滑值(秒)
+        self._cost = 0.
+
+    def getName(self):
+        return self._name
+
+    def getCost(self):
+        return self._cost
+
+    def getDropped(self):
+        """
+        输入槽中没来得及处理就被覆盖的数据个数
+        """
+        return self._in.getDropped()
+
+    def run(self):
+        while True:
+            item = self._in.get()
+            if item is None:
+                break
+            t = time.perf_counter()
+            try:
+                out = self._func(item)
+            except Exception as e:
+                # 单帧的异常不终止流水线
+                print("{} stage error: {}".format(self._name, e))
+                continue
+            self._cost = 0.9 * self._cost + 0.1 * (time.perf_counter() - t)
+            if out is None:
+                continue
+            for slot in self._outs:
+                slot.put(out)
+            self.output_sign.emit()
+
+
+class Pipeline(object):
+    """
+    由若干StageWorker组成的流水线,统一启动/停止
+    """
+
+    def __init__(self):
+        self._slots = []
+        self._stages = []
+
+    def addSlot(self, on_drop=None):
+        slot = LatestSlot(on_drop)
+        self._slots.append(slot)
+        return slot
+
+    def addStage(self, name, func, in_slot, out_slots=()):
+        stage = StageWorker(name, func, in_slot, out_slots)
+        self._stages.append(stage)
+        return stage
+
+    def isRunning(self):
+        return any(stage.isRunning() for stage in self._stages)
+
+    def start(self):
+        for slot in self._slots:
+            slot.open()
+        for stage in self._stages:
+            stage.start()
+
+    def stop(self):
+        """
+        关闭所有队列并等待各级线程退出,正在处理的数据会处理完
+        """
+        for slot in self._slots:
+            slot.close()
+        for stage in self._stages:
+            stage.wait()
+
+    def getStats(self):
+        """
+        :return: {名称: (平均耗时ms, 输入丢帧数)}
+        """
+        return {stage.getName(): (stage.getCost() * 1000, stage.getDropped()) for stage in self._stages}
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+import atexit
+import itertools
+import os
+import queue
+import time
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from src.face_detect_interface import FaceDetector, DetectResult
+
+"""
+多进程推理: FaceDetector运行在一个或多个子进程中,与界面/OpenCV不再争抢同一个GIL
+    * 图像通过共享内存中预分配的帧环传递,进程间只传递槽位下标和很小的检测记录,不序列化图像
+    * 每个槽位同一时刻只属于一个请求,推理完成后归还
+    * 多个子进程时请求发给当前最空闲的进程,可同时服务多路相机/多个调用线程
+    * 图像超过槽位大小时(如相机协商出比配置更大的分辨率)帧环按该图像重建,子进程重新附加
+"""
+
+# 帧环中每个槽位的最大图像尺寸(h, w, c)
+FRAME_SHAPE = (720, 1280, 3)
+
+
+class FrameRing(object):
+    """
+    共享内存帧环: slots个大小为frame_shape的uint8槽位
+    """
+
+    def __init__(self, slots, frame_shape=FRAME_SHAPE, name=None):
+        """
+        :param slots: 槽位个数
+        :param frame_shape: 槽位能容纳的最大图像尺寸
+        :param name: 共享内存名,为None时新建,否则附加到已有的共享内存(子进程)
+        """
+        self._slot_size = int(np.prod(frame_shape))
+        self._owner = name is None
+        # 子进程以spawn启动,与主进程共用同一个资源跟踪器,共享内存只由主进程unlink
+        self._shm = shared_memory.SharedMemory(name=name, create=self._owner, size=slots * self._slot_size)
+        self._frames = np.ndarray((slots, self._slot_size), dtype=np.uint8, buffer=self._shm.buf)
+
+    def getName(self):
+        return self._shm.name
+
+    def getSlotSize(self):
+        return self._slot_size
+
+    def view(self, idx, shape):
+        """
+        槽位上形状为shape的图像视图,不拷贝
+        """
+        return self._frames[idx, :int(np.prod(shape))].reshape(shape)
+
+    def write(self, idx, frame):
+        """
+        把图像(可以是裁剪视图)拷贝进槽位
+        """
+        if frame.dtype != np.uint8 or frame.size > self._slot_size:
+            raise ValueError("frame {} {} does not fit a {} byte ring slot".format(frame.shape, frame.dtype,
+                                                                                 self._slot_size))
+        np.copyto(self.view(idx, frame.shape), frame)
+
+    def close(self):
+        self._frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _worker_main(idx, ring_name, slots, frame_shape, weight_path, detector_kwargs, requests, results):
+    """
+    子进程入口: 创建检测器,循环处理请求 (seq, kind, payload),结果为 (seq, 进程下标, 状态, 数据)
+    """
+    try:
+        ring = FrameRing(slots, frame_shape, ring_name)
+        detector = FaceDetector(weight_path, **detector_kwargs)
+    except Exception as e:
+        results.put((None, idx, "error", repr(e)))
+        return
+    results.put((None, idx, "ready", None))
+    while True:
+        msg = requests.get()
+        if msg is None:
+            break
+        seq, kind, payload = msg
+        try:
+            if kind == "infer":
+                slot, shape, thresh, infer_shape = payload
+                res = detector.inference(ring.view(slot, shape), thresh, infer_shape=infer_shape)
+                out = (res.dets, res.target)
+            elif kind == "ring":
+                # 帧环已重建,附加到新的共享内存
+                ring_name, frame_shape = payload
+                ring.close()
+                ring = FrameRing(slots, frame_shape, ring_name)
+                out = None
+            else:
+                name, args, kwargs = payload
+                out = getattr(detector, name)(*args, **kwargs)
+            results.put((seq, idx, "ok", out))
+        except Exception as e:
+            results.put((seq, idx, "error", repr(e)))
+    ring.close()
+
+
+class ProcessDetector(object):
+    # 子进程加载模型的超时时间(秒)
+    _START_TIMEOUT = 300
+    # 等待子进程就绪时检查其是否存活的间隔(秒)
+    _START_POLL = 1.
+
+    def __init__(self, weight_path, workers=1, frame_shape=FRAME_SHAPE, **detector_kwargs):
+        """
+        :param weight_path: 同FaceDetector
+        :param workers: 推理子进程个数
+        :param frame_shape: 帧环槽位初始能容纳的最大图像尺寸(h, w, c),更大的图像到来时帧环自动重建
+        :param detector_kwargs: 传给子进程中FaceDetector的参数,默认按进程数均分CPU线程
+        """
+        self._workers = max(1, int(workers))
+        detector_kwargs.setdefault("max_threads", max(1, (os.cpu_count() or 1) // self._workers))
+        # spawn启动,子进程不继承界面和torch的线程状态
+        ctx = mp.get_context("spawn")
+        # 所有进程共享的推理计数,调优时据此判断是否有其他进程在推理
+        detector_kwargs["activity"] = ctx.RawValue("q", 0)
+        # 每个进程两个槽位: 一个在推理,一个在写入下一帧
+        slots = 2 * self._workers
+        self._slots = slots
+        self._ring = FrameRing(slots, frame_shape)
+        self._free = queue.Queue()
+        for i in range(slots):
+            self._free.put(i)
+
+        self._results = ctx.Queue()
+        self._requests = [ctx.Queue() for _ in range(self._workers)]
+        self._procs = [ctx.Process(target=_worker_main,
+                                   args=(i, self._ring.getName(), slots, frame_shape, weight_path, detector_kwargs,
+                                         self._requests[i], self._results),
+                                   daemon=True)
+                       for i in range(self._workers)]
+        self._closed = False
+        for p in self._procs:
+            p.start()
+        try:
+            self._waitReady()
+        except RuntimeError:
+            self.close()
+            raise
+
+        self._lock = threading.Lock()
+        # 重建帧环时持有,同一时刻只有一个线程在重建
+        self._ring_lock = threading.Lock()
+        self._seq = itertools.count()
+        # 等待中的请求 seq -> [事件, 结果],以及每个进程未完成的请求数
+        self._pending = {}
+        self._busy = [0] * self._workers
+        # get*接口的结果缓存,任何set*调用后失效
+        self._cache = {}
+        # 需要调优的输入尺寸,各进程依次调优
+        self._tune_shapes = []
+        self._tune_lock = threading.Lock()
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        atexit.register(self.close)
+        print('Inference workers: {} processes, {} ring slots'.format(self._workers, slots))
+
+    def _waitReady(self):
+        """
+        等待所有子进程加载完模型: 短超时轮询结果队列,期间检查未就绪的进程是否已退出,
+        进程在报告之前崩溃(导入失败/被系统杀死等)时立即报错,不必等到总超时
+        """
+        pending = set(range(self._workers))
+        deadline = time.monotonic() + self._START_TIMEOUT
+        while pending:
+            try:
+                _, idx, status, out = self._results.get(timeout=self._START_POLL)
+            except queue.Empty:
+                for i in sorted(pending):
+                    p = self._procs[i]
+                    if not p.is_alive():
+                        raise RuntimeError("inference worker {} exited before ready, exit code {}".format(
+                            i, p.exitcode))
+                if time.monotonic() > deadline:
+                    raise RuntimeError("inference workers {} failed to start: timeout".format(sorted(pending)))
+                continue
+            if status != "ready":
+                raise RuntimeError("inference worker {} failed to start: {}".format(idx, out))
+            pending.discard(idx)
+
+    def __getattr__(self, name):
+        # 其余接口转发给子进程中的FaceDetector: set*广播给所有进程, get*取第一个进程的结果并缓存
+        if not name.startswith(("get", "set")) or not callable(getattr(FaceDetector, name, None)):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            if name.startswith("get"):
+                key = (name, args, tuple(sorted(kwargs.items())))
+                if key not in self._cache:
+                    self._cache[key] = self._request(0, "call", (name, args, kwargs))
+                return self._cache[key]
+            self._cache.clear()
+            outs = [self._request(i, "call", (name, args, kwargs)) for i in range(self._workers)]
+            return outs[0]
+
+        return call
+
+    def getWorkers(self):
+        return self._workers
+
+    def setPrecision(self, precision):
+        """
+        所有进程切换精度,新精度的调优由各进程依次进行
+        :return: 实际使用的精度
+        """
+        self._cache.clear()
+        outs = [self._request(i, "call", ("setPrecision", (precision,), {"retune": False}))
+                for i in range(self._workers)]
+        if self._tune_shapes:
+            threading.Thread(target=self._tuneWorkers, daemon=True).start()
+        return outs[0]
+
+    def setTuneShapes(self, shapes):
+        """
+        在后台让各进程依次调优(同时调优会互相干扰计时),第一个进程保存结果后其余进程直接读取
+        :param shapes: 同FaceDetector.setTuneShapes
+        """
+        for w, h in shapes:
+            if (int(w), int(h)) not in self._tune_shapes:
+                self._tune_shapes.append((int(w), int(h)))
+        threading.Thread(target=self._tuneWorkers, daemon=True).start()
+
+    def _tuneWorkers(self):
+        with self._tune_lock:
+            try:
+                for i in range(self._workers):
+                    self._request(i, "call", ("setTuneShapes", (list(self._tune_shapes),), {}))
+                    while self._request(i, "call", ("isTuning", (), {})):
+                        time.sleep(0.5)
+            except RuntimeError as e:
+                print("Inference worker tuning stopped: {}".format(e))
+
+    def _collect(self):
+        """
+        结果收集线程: 把子进程的结果交给对应的等待者
+        """
+        while True:
+            msg = self._results.get()
+            if msg is None:
+                break
+            seq, idx, status, out = msg
+            with self._lock:
+                entry = self._pending.pop(seq, None)
+                self._busy[idx] -= 1
+            if entry is not None:
+                entry[1] = (status, out)
+                entry[0].set()
+
+    def _request(self, idx, kind, payload):
+        """
+        向第idx个进程发送请求并等待结果
+        """
+        if self._closed:
+            raise RuntimeError("inference workers are closed")
+        seq = next(self._seq)
+        entry = [threading.Event(), None]
+        with self._lock:
+            self._pending[seq] = entry
+            self._busy[idx] += 1
+        self._requests[idx].put((seq, kind, payload))
+        while not entry[0].wait(1.):
+            if not self._procs[idx].is_alive():
+                with self._lock:
+                    self._pending.pop(seq, None)
+                raise RuntimeError("inference worker {} exited".format(idx))
+        status, out = entry[1]
+        if status != "ok":
+            raise RuntimeError("inference worker {}: {}".format(idx, out))
+        return out
+
+    def _ensureRing(self, frame):
+        """
+        图像超过槽位大小时按该图像重建帧环: 先收回所有槽位(等待进行中的推理完成),
+        再让每个子进程附加到新的共享内存
+        """
+        if frame.nbytes <= self._ring.getSlotSize():
+            return
+        with self._ring_lock:
+            if frame.nbytes <= self._ring.getSlotSize():
+                return
+            slots = [self._free.get() for _ in range(self._slots)]
+            try:
+                ring = FrameRing(self._slots, frame.shape)
+                try:
+                    for i in range(self._workers):
+                        self._request(i, "ring", (ring.getName(), frame.shape))
+                except Exception:
+                    ring.close()
+                    raise
+                self._ring, ring = ring, self._ring
+                ring.close()
+            finally:
+                for slot in slots:
+                    self._free.put(slot)
+        print('Inference ring slots resized for {}x{} frames'.format(frame.shape[1], frame.shape[0]))
+
+    def inference(self, frame, thresh=0.7, infer_shape=None):
+        """
+        与FaceDetector.inference相同的接口,可在多个线程中同时调用
+        :return: DetectResult
+        """
+        if frame.dtype == np.uint8:
+            self._ensureRing(frame)
+        slot = self._free.get()
+        try:
+            self._ring.write(slot, frame)
+            with self._lock:
+                idx = int(np.argmin(self._busy))
+            dets, target = self._request(idx, "infer", (slot, frame.shape, thresh, infer_shape))
+        finally:
+            self._free.put(slot)
+        return DetectResult(dets, target)
+
+    def close(self):
+        """
+        停止子进程并释放共享内存
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for q in self._requests:
+            q.put(None)
+        for p in self._procs:
+            if p.pid is None:
+                continue
+            p.join(5)
+            if p.is_alive():
+                p.terminate()
+        self._results.put(None)
+        self._ring.close()
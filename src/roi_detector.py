@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+"""
+检测-跟踪模式: 找到人脸后,下一帧只在上一个目标框周围的局部区域内检测
+    * 局部区域为以目标框为中心的正方形,边长取自固定的几档尺寸,避免每帧都是新的输入尺寸
+      (编译引擎/自动调优/缓冲区都按输入尺寸缓存)
+    * 每隔full_interval帧做一次全图检测,局部区域丢失人脸时立即在同一帧上做全图检测
+    * 局部区域按全图检测相同的缩放比例送入网络,推理尺寸配置同样约束局部检测的计算量
+    * 结果坐标已映射回整幅图像,下游的追踪策略无感知
+"""
+
+
+class RoiDetector(object):
+    # 局部区域的边长档位
+    ROI_SIZES = (128, 192, 256, 320, 384, 448, 512, 640)
+    # 局部区域起点的对齐步长
+    ROI_ALIGN = 32
+
+    def __init__(self, detector, enabled=True, pad=0.5, full_interval=30):
+        """
+        :param detector: FaceDetector
+        :param enabled: 是否启用局部检测,关闭时每帧都做全图检测
+        :param pad: 目标框每边向外扩展的比例,局部区域边长约为目标框长边的(1 + 2 * pad)倍
+        :param full_interval: 连续局部检测的最大帧数,之后强制做一次全图检测
+        """
+        self._detector = detector
+        self._enabled = enabled
+        self._pad = pad
+        self._full_interval = full_interval
+        self._last_box = None
+        self._last_roi = None
+        self._since_full = 0
+
+    def __getattr__(self, name):
+        # 其余接口(精度/推理尺寸等)直接转给内部的检测器
+        return getattr(self._detector, name)
+
+    def reset(self):
+        """
+        丢弃上一个目标,下一帧做全图检测
+        """
+        self._last_box = None
+        self._last_roi = None
+        self._since_full = 0
+
+    def getLastRoi(self):
+        """
+        上一帧实际搜索的局部区域(x0, y0, size),全图检测时为None
+        """
+        return self._last_roi
+
+    def setTrackBox(self, box):
+        """
+        由上层的多目标跟踪指定下一帧局部区域跟随的目标框
+        """
+        self._last_box = np.array(box, dtype=np.float32)
+
+    def getRoi(self, box, im_width, im_height):
+        """
+        计算目标框周围的局部区域
+        :param box: 上一个目标框 (x1, y1, x2, y2)
+        :return: (x0, y0, size),局部区域不比整幅图像小很多时返回None
+        """
+        need = max(box[2] - box[0], box[3] - box[1]) * (1 + 2 * self._pad)
+        size = None
+        for s in self.ROI_SIZES:
+            if s >= need:
+                size = s
+                break
+        if size is None or size >= min(im_width, im_height):
+            return None
+        cx = (box[0] + box[2]) / 2
+        cy = (box[1] + box[3]) / 2
+        # 居中放置,超出图像时平移回图像内
+        x0 = int(np.clip(round(cx - size / 2), 0, im_width - size))
+        y0 = int(np.clip(round(cy - size / 2), 0, im_height - size))
+        # 起点对齐到网络的最大步长,局部区域上的特征网格与全图检测时一致,分数更稳定
+        return x0 // self.ROI_ALIGN * self.ROI_ALIGN, y0 // self.ROI_ALIGN * self.ROI_ALIGN, size
+
+    def getRoiInferSize(self, size, im_width, im_height):
+        """
+        局部区域送入网络的边长: 按全图的推理缩放比例缩放,并对齐到网络的最大步长
+        :param size: 局部区域边长
+        :return: 推理边长,相机分辨率固定时只有ROI_SIZES对应的几档
+        """
+        in_width, in_height = self._detector.getInferShape(im_width, im_height)
+        r = min(in_width / im_width, in_height / im_height)
+        return max(self.ROI_ALIGN, int(round(size * r / self.ROI_ALIGN)) * self.ROI_ALIGN)
+
+    def getRoiInferSizes(self, im_width, im_height):
+        """
+        给定相机分辨率下局部检测会用到的全部推理边长(用于提前调优)
+        """
+        return sorted(set(self.getRoiInferSize(s, im_width, im_height) for s in self.ROI_SIZES))
+
+    def inference(self, frame, thresh=0.7):
+        """
+        与FaceDetector.inference相同的接口
+        :return: 整幅图像坐标下的DetectResult
+        """
+        im_height, im_width = frame.shape[:2]
+        if self._enabled and self._last_box is not None and self._since_full < self._full_interval:
+            roi = self.getRoi(self._last_box, im_width, im_height)
+            if roi is not None:
+                x0, y0, size = roi
+                # 检测器对输入做镜像时,目标框是镜像后画面的坐标,裁剪位置需要镜像回原图
+                xf = im_width - x0 - size if self._detector.getInputFormat()[1] else x0
+                in_size = self.getRoiInferSize(size, im_width, im_height)
+                res = self._detector.inference(frame[y0:y0 + size, xf:xf + size], thresh,
+                                               infer_shape=(in_size, in_size))
+                if res.hasTarget():
+                    res.shift(x0, y0)
+                    self._last_box = res.box.copy()
+                    self._last_roi = roi
+                    self._since_full += 1
+                    return res
+
+        res = self._detector.inference(frame, thresh)
+        self._last_box = res.box.copy() if res.hasTarget() else None
+        self._last_roi = None
+        self._since_full = 0
+        return res
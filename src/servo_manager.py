@@ -35,6 +35,9 @@ class ServoManager(object):
         self.vertical_servo_angle = 0
         self.horizontal_servo_angle = 0
         self._is_random = False
+        # moveA已发送的命令数,以及最近一条命令写入到收到应答的耗时(秒)
+        self._cmd_count = 0
+        self._cmd_time = 0.
 
     def isAlive(self):
         """
@@ -176,12 +179,27 @@ class ServoManager(object):
             return False, "存在舵机超行程."
         send_str = "#1P{}#2P{}T{}\r\n".format(self._angler2Value(y_ang), self._angler2Value(x_ang), speed)
         assert isinstance(self.serial, serial.Serial), ""
+        t = time.perf_counter()
         self.serial.write(send_str.encode("utf-8"))
         self._waitRead()
+        self._cmd_time = time.perf_counter() - t
+        self._cmd_count += 1
         self.vertical_servo_angle = y_ang
         self.horizontal_servo_angle = x_ang
         return True, ""
 
+    def getCommandCount(self):
+        """
+        moveA实际写入串口的命令数
+        """
+        return self._cmd_count
+
+    def getLastCommandTime(self):
+        """
+        最近一条moveA命令的串口往返耗时(秒)
+        """
+        return self._cmd_time
+
     def moveUp(self, step: int, speed: int = 100):
         ang = self.getVerticalServoAngle() - step
         if ang < 0:
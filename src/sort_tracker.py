@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+import time
+import numpy as np
+from src.face_detect_interface import DetectResult, DET_DTYPE
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+"""
+多人脸跟踪(SORT): 每个人脸一条轨迹,轨迹有稳定的id,追踪目标按轨迹选择而不是每帧取面积最大的人脸
+    * 所有轨迹的卡尔曼预测/更新、IoU代价矩阵都是批量向量化计算的
+    * 匈牙利算法做检测与轨迹的关联,优先使用scipy,没有安装时使用numpy实现
+    * 目标选择策略: sticky 锁定当前目标直到其轨迹消失 / largest 面积最大 / center 离画面中心最近
+      当前目标连续lost_frames次没有检测到时切换到最优的已确认轨迹,不等其轨迹过期
+    * 检测不是每帧都做(光流跟踪/静止跳过),卡尔曼预测按相邻两次检测的帧时间间隔外推
+"""
+
+TARGET_POLICIES = ("sticky", "largest", "center")
+
+
+def iou_matrix(a, b):
+    """
+    :param a: [n, 4] (x1, y1, x2, y2)
+    :param b: [m, 4]
+    :return: [n, m]
+    """
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(rb - lt, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+def _hungarian(cost):
+    """
+    最小代价的二分图匹配(势能法, O(n^2 m)),内层循环按列向量化
+    :param cost: [n, m]
+    :return: (rows, cols)
+    """
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    # p[j]: 第j列匹配的行(从1开始, 0为未匹配), way: 增广路径
+    p = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            cur = cost[i0 - 1] - u[i0] - v[1:]
+            free = ~used[1:]
+            upd = free & (cur < minv[1:])
+            minv[1:][upd] = cur[upd]
+            way[1:][upd] = j0
+            j1 = int(np.argmin(np.where(free, minv[1:], np.inf))) + 1
+            delta = minv[j1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    cols = np.nonzero(p[1:])[0]
+    rows = p[1:][cols] - 1
+    order = np.argsort(rows)
+    rows, cols = rows[order], cols[order]
+    return (cols, rows) if transposed else (rows, cols)
+
+
+def assign(cost):
+    """
+    :return: (rows, cols) 匹配对
+    """
+    if cost.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    if linear_sum_assignment is not None:
+        return linear_sum_assignment(cost)
+    return _hungarian(cost)
+
+
+def _box_to_z(box):
+    """
+    (x1, y1, x2, y2) -> (cx, cy, 面积, 宽高比)
+    """
+    w = box[:, 2] - box[:, 0]
+    h = box[:, 3] - box[:, 1]
+    return np.stack([box[:, 0] + w / 2, box[:, 1] + h / 2, w * h, w / np.maximum(h, 1e-6)], axis=1)
+
+
+def _x_to_box(x):
+    s = np.maximum(x[:, 2], 1e-6)
+    w = np.sqrt(s * x[:, 3])
+    h = s / np.maximum(w, 1e-6)
+    return np.stack([x[:, 0] - w / 2, x[:, 1] - h / 2, x[:, 0] + w / 2, x[:, 1] + h / 2], axis=1)
+
+
+class SortTracker(object):
+    # 状态 [cx, cy, 面积, 宽高比, vx, vy, v面积],匀速模型,速度以 每个标称帧周期 为单位
+    _H = np.eye(4, 7)
+    _Q = np.diag([1., 1., 1., 1., 0.01, 0.01, 0.0001])
+    _R = np.diag([1., 1., 10., 10.])
+    _P0 = np.diag([10., 10., 10., 10., 10000., 10000., 10000.])
+
+    def __init__(self, detector, policy="sticky", iou_thresh=0.3, max_age=15, min_hits=2, switch_margin=1.2,
+                 lost_frames=3, frame_period=1. / 30):
+        """
+        :param detector: 返回整幅图像坐标的检测器(FaceDetector/RoiDetector)
+        :param policy: 目标选择策略 sticky/largest/center
+        :param iou_thresh: 关联所需的最小IoU
+        :param max_age: 轨迹连续未被检测到的最大帧数
+        :param min_hits: 轨迹被确认(参与输出)所需的检测次数
+        :param switch_margin: largest/center策略下,其他人脸需要优于当前目标的倍数才切换
+        :param lost_frames: 当前目标连续多少次没有检测到后切换到其他已确认的轨迹
+        :param frame_period: 标称帧周期(秒),卡尔曼预测的时间步以此为单位
+        """
+        assert policy in TARGET_POLICIES, "unknown target policy {}".format(policy)
+        self._detector = detector
+        self._policy = policy
+        self._iou_thresh = iou_thresh
+        self._max_age = max_age
+        self._min_hits = min_hits
+        self._switch_margin = switch_margin
+        self._lost_frames = lost_frames
+        self._frame_period = frame_period
+        self._frame_time = None
+        self.reset()
+
+    def __getattr__(self, name):
+        return getattr(self._detector, name)
+
+    def reset(self):
+        self._x = np.zeros((0, 7))
+        self._P = np.zeros((0, 7, 7))
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._hits = np.zeros(0, dtype=np.int64)
+        self._misses = np.zeros(0, dtype=np.int64)
+        self._scores = np.zeros(0, dtype=np.float32)
+        self._next_id = 0
+        self._target_id = -1
+        self._last_time = None
+        if hasattr(self._detector, "reset"):
+            self._detector.reset()
+
+    def setPolicy(self, policy):
+        assert policy in TARGET_POLICIES, "unknown target policy {}".format(policy)
+        self._policy = policy
+
+    def getTargetId(self):
+        return self._target_id
+
+    def setFrameTime(self, t):
+        """
+        设置下一次inference的帧采集时间(time.perf_counter),没有设置时使用调用时刻
+        """
+        self._frame_time = t
+
+    def _timeStep(self):
+        """
+        与上一次检测的帧时间间隔,以标称帧周期为单位,最多外推max_age个周期
+        """
+        t = self._frame_time if self._frame_time is not None else time.perf_counter()
+        self._frame_time = None
+        dt = 1. if self._last_time is None else (t - self._last_time) / self._frame_period
+        self._last_time = t
+        return min(max(dt, 0.), float(self._max_age))
+
+    def _predict(self, dt=1.):
+        F = np.eye(7)
+        F[0, 4] = F[1, 5] = F[2, 6] = dt
+        self._x = self._x @ F.T
+        # 过程噪声随时间步增长
+        self._P = F @ self._P @ F.T + self._Q * max(dt, 1e-3)
+        # 面积不能为负
+        self._x[:, 2] = np.maximum(self._x[:, 2], 1e-6)
+
+    def _update(self, idx, z):
+        """
+        批量更新idx对应的轨迹
+        """
+        H = self._H
+        P = self._P[idx]
+        S = H @ P @ H.T + self._R
+        K = P @ H.T @ np.linalg.inv(S)
+        y = z - self._x[idx] @ H.T
+        self._x[idx] += np.einsum('nij,nj->ni', K, y)
+        self._P[idx] = (np.eye(7) - K @ H) @ P
+
+    def _observed(self, boxes):
+        """
+        本帧检测器实际搜索过的轨迹,局部区域检测时区域外的轨迹不计为丢失
+        """
+        roi = self._detector.getLastRoi() if hasattr(self._detector, "getLastRoi") else None
+        if roi is None:
+            return np.ones(len(boxes), dtype=bool)
+        x0, y0, size = roi
+        cx = (boxes[:, 0] + boxes[:, 2]) / 2
+        cy = (boxes[:, 1] + boxes[:, 3]) / 2
+        return (cx >= x0) & (cx < x0 + size) & (cy >= y0) & (cy < y0 + size)
+
+    def _selectTarget(self, rec, im_width, im_height):
+        """
+        按策略在本帧输出的轨迹中选择目标
+        :return: rec中目标的下标
+        """
+        if len(rec) == 0:
+            return -1
+        cur = np.nonzero(rec['id'] == self._target_id)[0]
+        lost = self._misses[self._ids == self._target_id]
+        if len(cur) == 0 and len(lost) and lost[0] < self._lost_frames:
+            # 当前目标短暂没有检测到但轨迹还在,本帧不输出目标,也不切换目标
+            return -1
+        if self._policy == "sticky" and len(cur):
+            return int(cur[0])
+        box = rec['box']
+        if self._policy == "center":
+            # 离中心越近越好
+            cost = np.hypot(rec['keyp'][:, 0] - im_width / 2, rec['keyp'][:, 1] - im_height / 2)
+        else:
+            # 面积越大越好
+            cost = 1. / np.maximum((box[:, 2] - box[:, 0]) * (box[:, 3] - box[:, 1]), 1e-6)
+        best = int(np.argmin(cost))
+        if len(cur) and cost[best] * self._switch_margin >= cost[cur[0]]:
+            # 滞回: 其他人脸没有明显更优时保持当前目标,避免两个人脸相近时来回切换
+            return int(cur[0])
+        return best
+
+    def inference(self, frame, thresh=0.7):
+        """
+        与FaceDetector.inference相同的接口
+        :return: DetectResult,dets为本帧检测到的已确认轨迹,id字段为轨迹id
+        """
+        dt = self._timeStep()
+        res = self._detector.inference(frame, thresh)
+        det_boxes = res.dets['box']
+        self._predict(dt)
+
+        # 关联
+        track_boxes = _x_to_box(self._x)
+        iou = iou_matrix(track_boxes, det_boxes)
+        rows, cols = assign(-iou)
+        ok = iou[rows, cols] >= self._iou_thresh
+        rows, cols = rows[ok], cols[ok]
+
+        matched = np.zeros(len(self._ids), dtype=bool)
+        matched[rows] = True
+        if len(rows):
+            self._update(rows, _box_to_z(det_boxes[cols]))
+            self._scores[rows] = res.dets['score'][cols]
+        self._hits[rows] += 1
+        self._misses[rows] = 0
+        self._misses[~matched & self._observed(track_boxes)] += 1
+
+        # 未匹配的检测新建轨迹
+        new = np.ones(len(det_boxes), dtype=bool)
+        new[cols] = False
+        n_new = int(new.sum())
+        if n_new:
+            z = _box_to_z(det_boxes[new])
+            self._x = np.concatenate([self._x, np.concatenate([z, np.zeros((n_new, 3))], axis=1)])
+            self._P = np.concatenate([self._P, np.repeat(self._P0[None], n_new, axis=0)])
+            self._ids = np.concatenate([self._ids, np.arange(self._next_id, self._next_id + n_new)])
+            self._hits = np.concatenate([self._hits, np.ones(n_new, dtype=np.int64)])
+            self._misses = np.concatenate([self._misses, np.zeros(n_new, dtype=np.int64)])
+            self._scores = np.concatenate([self._scores, res.dets['score'][new]])
+            self._next_id += n_new
+
+        # 删除过期轨迹
+        alive = self._misses <= self._max_age
+        if not alive.all():
+            self._x, self._P = self._x[alive], self._P[alive]
+            self._ids, self._hits = self._ids[alive], self._hits[alive]
+            self._misses, self._scores = self._misses[alive], self._scores[alive]
+
+        # 输出本帧检测到的已确认轨迹,框使用滤波后的位置
+        out = (self._misses == 0) & (self._hits >= self._min_hits)
+        rec = np.empty(int(out.sum()), dtype=DET_DTYPE)
+        rec['box'] = _x_to_box(self._x[out])
+        rec['score'] = self._scores[out]
+        rec['keyp'] = (rec['box'][:, :2] + rec['box'][:, 2:]) / 2
+        rec['id'] = self._ids[out]
+        order = np.argsort(-rec['score'])
+        rec = rec[order]
+
+        target = self._selectTarget(rec, frame.shape[1], frame.shape[0])
+        if target >= 0:
+            self._target_id = int(rec['id'][target])
+            if hasattr(self._detector, "setTrackBox"):
+                # 局部区域检测跟随选中的目标
+                self._detector.setTrackBox(rec['box'][target])
+        elif self._target_id not in self._ids:
+            self._target_id = -1
+        return DetectResult(rec, target)
@@ -151,6 +151,18 @@ class Ui_Camera(object):
         self.devLineEdit.setReadOnly(True)
         self.devLineEdit.setObjectName("devLineEdit")
         self.gridLayout_4.addWidget(self.devLineEdit, 3, 1, 1, 1)
+        self.precisionLabel = BodyLabel(self.infoCardWidget)
+        self.precisionLabel.setAlignment(QtCore.Qt.AlignCenter)
+        self.precisionLabel.setObjectName("precisionLabel")
+        self.gridLayout_4.addWidget(self.precisionLabel, 5, 0, 1, 1)
+        self.precisionBox = ComboBox(self.infoCardWidget)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Preferred)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.precisionBox.sizePolicy().hasHeightForWidth())
+        self.precisionBox.setSizePolicy(sizePolicy)
+        self.precisionBox.setObjectName("precisionBox")
+        self.gridLayout_4.addWidget(self.precisionBox, 5, 1, 1, 1)
         self.gridLayout_2.addWidget(self.infoCardWidget, 0, 0, 1, 1)
         self.gridLayout.addWidget(self.setCardWidget, 1, 0, 1, 1)
 
@@ -167,4 +179,5 @@ class Ui_Camera(object):
         self.nameLabel.setText(_translate("Camera", "设备名"))
         self.posLabel.setText(_translate("Camera", "关键点位置"))
         self.devLabel.setText(_translate("Camera", "推理设备"))
+        self.precisionLabel.setText(_translate("Camera", "推理精度"))
 from qfluentwidgets import BodyLabel, CardWidget, ComboBox, ImageLabel, LineEdit, PlainTextEdit, PushButton, ToolButton